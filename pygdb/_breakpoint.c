@@ -22,12 +22,356 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 -- END_HEADER --- */
 
 #include <Python.h>
+#include <frameobject.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <signal.h>
+#include <unistd.h>
+
+#if defined(__GNUC__)
+#define PYGDB_NOINLINE __attribute__((noinline))
+#else
+#define PYGDB_NOINLINE
+#endif
 
 // NOTE: We need a non-static function for the GDB breakpoint
 PyObject* _pygdb_breakpoint_mark() {
 	return Py_BuildValue("");
 }
 
+/*
+ * Python line stepping for the GDB console (see pygdb.console.extensions).
+ *
+ * The console installs _pygdb_trace as the C trace function of a thread by
+ * writing its PyThreadState, and arms it by writing the _pygdb_step_*
+ * variables below. The inferior then runs at full speed and the trace
+ * function calls _pygdb_breakpoint_step, where the console has a breakpoint,
+ * once the python line of the stepped thread state changes. Other threads
+ * still running the trace function, e.g. for py-break, never stop for a
+ * step. When disarmed, and no py-break breakpoints are set, the trace
+ * function removes itself from the thread on the next trace event.
+ */
+
+#define PYGDB_STEP_OFF 0
+#define PYGDB_STEP_LINE 1
+#define PYGDB_STEP_NEXT 2
+#define PYGDB_STEP_RETURN 3
+
+volatile int _pygdb_step_mode = PYGDB_STEP_OFF;
+PyThreadState * volatile _pygdb_step_tstate = NULL;
+PyFrameObject * volatile _pygdb_step_frame = NULL;
+volatile int _pygdb_step_lineno = -1;
+
+// The frame and trace event argument (e.g. the returned value) of the
+// last stop, for the GDB console
+PyFrameObject * volatile _pygdb_stop_frame = NULL;
+PyObject * volatile _pygdb_stop_arg = NULL;
+
+// NOTE: Non-static and never inlined for the GDB breakpoint
+PYGDB_NOINLINE void _pygdb_breakpoint_step(PyFrameObject *frame,
+		PyObject *arg) {
+	_pygdb_stop_frame = frame;
+	_pygdb_stop_arg = arg;
+}
+
+/*
+ * Python source line breakpoints for the GDB console (py-break).
+ *
+ * The console writes the first _pygdb_break_count entries of the tables
+ * below and installs _pygdb_trace in all threads, which calls
+ * _pygdb_breakpoint_line when a thread reaches one of the lines. The line
+ * number is compared first, so non-matching lines cost a few compares and
+ * never stop in GDB.
+ */
+
+#define PYGDB_MAX_BREAKS 64
+#define PYGDB_MAX_BREAK_PATH 1024
+
+volatile int _pygdb_break_count = 0;
+int _pygdb_break_lines[PYGDB_MAX_BREAKS];
+// The file names, or a trailing part of them, e.g. "pkg/module.py"
+char _pygdb_break_files[PYGDB_MAX_BREAKS][PYGDB_MAX_BREAK_PATH];
+
+// The breakpoint index of the last stop at a breakpoint, for the console
+volatile int _pygdb_stop_break = -1;
+
+// NOTE: Non-static and never inlined for the GDB breakpoint
+PYGDB_NOINLINE void _pygdb_breakpoint_line(PyFrameObject *frame, int index) {
+	_pygdb_stop_frame = frame;
+	_pygdb_stop_break = index;
+}
+
+static int filename_matches(const char *filename, const char *pattern) {
+	size_t len = strlen(filename);
+	size_t pattern_len = strlen(pattern);
+
+	if (pattern_len == 0 || pattern_len > len) {
+		return 0;
+	}
+	if (strcmp(filename + len - pattern_len, pattern) != 0) {
+		return 0;
+	}
+	// A whole path or a trailing part of it starting at a directory
+	return pattern_len == len || pattern[0] == '/'
+		|| filename[len - pattern_len - 1] == '/';
+}
+
+static int find_break(PyFrameObject *frame) {
+	int i;
+	int count = _pygdb_break_count;
+
+	for (i = 0; i < count && i < PYGDB_MAX_BREAKS; i++) {
+		if (_pygdb_break_lines[i] == frame->f_lineno
+				&& PyString_Check(frame->f_code->co_filename)
+				&& filename_matches(
+					PyString_AS_STRING(frame->f_code->co_filename),
+					_pygdb_break_files[i])) {
+			return i;
+		}
+	}
+	return -1;
+}
+
+int _pygdb_trace(PyObject *obj, PyFrameObject *frame, int what, PyObject *arg) {
+	int index;
+	int mode = _pygdb_step_mode;
+
+	if (what == PyTrace_LINE && _pygdb_break_count > 0) {
+		index = find_break(frame);
+		if (index >= 0) {
+			_pygdb_breakpoint_line(frame, index);
+		}
+	}
+
+	if (mode != PYGDB_STEP_OFF && frame->f_tstate != _pygdb_step_tstate) {
+		// Another thread is being stepped
+		return 0;
+	}
+
+	switch (mode) {
+	case PYGDB_STEP_LINE:
+		// Any new line, in this frame or in a frame called from it
+		if (what == PyTrace_LINE
+				&& (frame != _pygdb_step_frame
+					|| frame->f_lineno != _pygdb_step_lineno)) {
+			_pygdb_breakpoint_step(frame, arg);
+		}
+		break;
+	case PYGDB_STEP_NEXT:
+		// A new line in this very frame, not in recursive calls of its code
+		if (frame != _pygdb_step_frame) {
+			break;
+		}
+		if (what == PyTrace_LINE && frame->f_lineno != _pygdb_step_lineno) {
+			_pygdb_breakpoint_step(frame, arg);
+		} else if (what == PyTrace_RETURN) {
+			// Continue with the next line of the caller
+			if (frame->f_back == NULL) {
+				_pygdb_breakpoint_step(frame, arg);
+			}
+			_pygdb_step_frame = frame->f_back;
+			_pygdb_step_lineno = -1;
+		}
+		break;
+	case PYGDB_STEP_RETURN:
+		// This frame returning or unwinding with an exception (arg NULL)
+		if (what == PyTrace_RETURN && frame == _pygdb_step_frame) {
+			_pygdb_breakpoint_step(frame, arg);
+		}
+		break;
+	default:
+		if (_pygdb_break_count == 0) {
+			PyEval_SetTrace(NULL, NULL);
+		}
+		break;
+	}
+	return 0;
+}
+
+/*
+ * Waiting for the GDB console (see pygdb.breakpoint.set).
+ *
+ * py-attach signals the attached process with SIGCONT. The SIGCONT handler
+ * installed by enable_console_wakeup writes a byte to a pipe that is never
+ * read, so every thread waiting for the console in wait_console, with the
+ * GIL released, wakes up at once. The previous handler, e.g. the python
+ * signal handler, is called after.
+ */
+
+static int console_pipe[2] = {-1, -1};
+static volatile sig_atomic_t console_attached = 0;
+static struct sigaction console_prev_action;
+
+static void console_sigcont(int signum, siginfo_t *info, void *context) {
+	int saved_errno = errno;
+	char byte = 1;
+
+	console_attached = 1;
+	if (write(console_pipe[1], &byte, 1) < 0) {
+		// The pipe is full, i.e. the waiters are woken already
+	}
+	errno = saved_errno;
+
+	if (console_prev_action.sa_flags & SA_SIGINFO) {
+		if (console_prev_action.sa_sigaction != NULL) {
+			console_prev_action.sa_sigaction(signum, info, context);
+		}
+	} else if (console_prev_action.sa_handler != SIG_DFL
+			&& console_prev_action.sa_handler != SIG_IGN) {
+		console_prev_action.sa_handler(signum);
+	}
+}
+
+static PyObject* enable_console_wakeup(PyObject* self) {
+	struct sigaction action;
+	int i;
+
+	if (console_pipe[0] >= 0) {
+		Py_RETURN_NONE;
+	}
+	if (pipe(console_pipe) != 0) {
+		return PyErr_SetFromErrno(PyExc_OSError);
+	}
+	for (i = 0; i < 2; i++) {
+		fcntl(console_pipe[i], F_SETFD, FD_CLOEXEC);
+		fcntl(console_pipe[i], F_SETFL,
+			fcntl(console_pipe[i], F_GETFL) | O_NONBLOCK);
+	}
+
+	memset(&action, 0, sizeof(action));
+	action.sa_sigaction = console_sigcont;
+	action.sa_flags = SA_SIGINFO | SA_RESTART;
+	sigemptyset(&action.sa_mask);
+	if (sigaction(SIGCONT, &action, &console_prev_action) != 0) {
+		return PyErr_SetFromErrno(PyExc_OSError);
+	}
+	Py_RETURN_NONE;
+}
+
+static PyObject* wait_console(PyObject* self) {
+	struct pollfd fd;
+	int result;
+
+	if (console_pipe[0] < 0) {
+		PyErr_SetString(PyExc_RuntimeError,
+			"enable_console_wakeup has not been called");
+		return NULL;
+	}
+	Py_BEGIN_ALLOW_THREADS
+	do {
+		fd.fd = console_pipe[0];
+		fd.events = POLLIN;
+		fd.revents = 0;
+		result = poll(&fd, 1, -1);
+	} while (result < 0 && errno == EINTR && !console_attached);
+	Py_END_ALLOW_THREADS
+
+	if (result < 0 && errno != EINTR) {
+		return PyErr_SetFromErrno(PyExc_OSError);
+	}
+	Py_RETURN_NONE;
+}
+
+static PyObject* is_console_attached(PyObject* self) {
+	return PyBool_FromLong(console_attached);
+}
+
+/*
+ * Named breakpoints (see pygdb.breakpoint.set).
+ *
+ * Each name gets an id on first use, with an entry in the tables below.
+ * The GDB console arms and disarms the ids by writing _pygdb_named_armed
+ * directly, without signalling or resuming the process, and reads the
+ * names and hit counters. It also adds entries for names not reached yet,
+ * which the process picks up on first use. Names are significant up to
+ * PYGDB_MAX_NAME - 1 bytes. A disarmed breakpoint costs a dict lookup, a
+ * counter increment and a flag test.
+ */
+
+#define PYGDB_MAX_NAMED 256
+#define PYGDB_MAX_NAME 64
+
+volatile int _pygdb_named_count = 0;
+char _pygdb_named_names[PYGDB_MAX_NAMED][PYGDB_MAX_NAME];
+volatile int _pygdb_named_armed[PYGDB_MAX_NAMED];
+volatile unsigned long _pygdb_named_hits[PYGDB_MAX_NAMED];
+
+static PyObject *named_ids = NULL;
+
+static PyObject* named_id(PyObject *name) {
+	PyObject *id;
+	int count = _pygdb_named_count;
+	int index;
+
+	id = PyDict_GetItem(named_ids, name);
+	if (id != NULL) {
+		return id;
+	}
+	// An entry added by the console before the name was first used
+	for (index = 0; index < count && index < PYGDB_MAX_NAMED; index++) {
+		if (strncmp(_pygdb_named_names[index], PyString_AS_STRING(name),
+				PYGDB_MAX_NAME - 1) == 0) {
+			break;
+		}
+	}
+	if (index >= PYGDB_MAX_NAMED) {
+		// NOTE: Names beyond the table are never armed, and get the id -1
+		// so that later uses cost a single lookup
+		index = -1;
+	}
+	id = PyInt_FromLong(index);
+	if (id == NULL || PyDict_SetItem(named_ids, name, id) != 0) {
+		Py_XDECREF(id);
+		return NULL;
+	}
+	Py_DECREF(id);
+	if (index == count) {
+		strncpy(_pygdb_named_names[count], PyString_AS_STRING(name),
+			PYGDB_MAX_NAME - 1);
+		_pygdb_named_names[count][PYGDB_MAX_NAME - 1] = '\0';
+		_pygdb_named_armed[count] = 0;
+		_pygdb_named_hits[count] = 0;
+		_pygdb_named_count = count + 1;
+	}
+	return id;
+}
+
+static PyObject* is_armed(PyObject* self, PyObject *name) {
+	PyObject *id_obj;
+	long id;
+
+	if (PyUnicode_Check(name)) {
+		name = PyUnicode_AsUTF8String(name);
+	} else if (PyString_Check(name)) {
+		Py_INCREF(name);
+	} else {
+		// NOTE: Breakpoints without a usable name are skipped
+		Py_RETURN_FALSE;
+	}
+	if (name == NULL) {
+		PyErr_Clear();
+		Py_RETURN_FALSE;
+	}
+	id_obj = named_id(name);
+	Py_DECREF(name);
+	if (id_obj == NULL) {
+		if (PyErr_Occurred()) {
+			return NULL;
+		}
+		Py_RETURN_FALSE;
+	}
+	id = PyInt_AS_LONG(id_obj);
+	if (id < 0) {
+		Py_RETURN_FALSE;
+	}
+	_pygdb_named_hits[id]++;
+	if (!_pygdb_named_armed[id]) {
+		Py_RETURN_FALSE;
+	}
+	Py_RETURN_TRUE;
+}
+
 static PyObject* breakpoint_mark(PyObject* self) {
 	return _pygdb_breakpoint_mark();
 }
@@ -35,14 +379,46 @@ static PyObject* breakpoint_mark(PyObject* self) {
 static char breakpoint_mark_docs[] = \
     "Used for python GDB breakpoints.\n";
 
+static char enable_console_wakeup_docs[] = \
+    "Wake up the threads waiting for the GDB console on SIGCONT.\n";
+
+static char wait_console_docs[] = \
+    "Block, without the GIL, until the GDB console is attached.\n";
+
+static char is_console_attached_docs[] = \
+    "True once the GDB console is attached.\n";
+
+static char is_armed_docs[] = \
+    "Count a pass of the named breakpoint, True if the console armed it.\n";
+
 static PyMethodDef breakpoint_mark_funcs[] = {
     {"breakpoint_mark",
     (PyCFunction)breakpoint_mark,
     METH_NOARGS,
     breakpoint_mark_docs},
+    {"enable_console_wakeup",
+    (PyCFunction)enable_console_wakeup,
+    METH_NOARGS,
+    enable_console_wakeup_docs},
+    {"wait_console",
+    (PyCFunction)wait_console,
+    METH_NOARGS,
+    wait_console_docs},
+    {"is_console_attached",
+    (PyCFunction)is_console_attached,
+    METH_NOARGS,
+    is_console_attached_docs},
+    {"is_armed",
+    (PyCFunction)is_armed,
+    METH_O,
+    is_armed_docs},
     {NULL}
 };
 
 void init_pygdb(void) {	
+    named_ids = PyDict_New();
+    if (named_ids == NULL) {
+        return;
+    }
     Py_InitModule3("_pygdb", breakpoint_mark_funcs, breakpoint_mark_docs);
 }
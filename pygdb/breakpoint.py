@@ -34,23 +34,26 @@ USAGE:
 import pygdb.breakpoint
 pygdb.breakpoint.enable()
 pygdb.breakpoint.set()
+pygdb.breakpoint.set(name='mainloop')
 
 This will block the executing thread (at the pygdb.breakpoint.set() call)
-until 'pygdb.console.extension.console_connected' is called
-from the GDB console.
+until the GDB console is attached with 'py-attach', which signals the
+process with SIGCONT.
+
+Named breakpoints are disarmed until armed from the GDB console with
+'py-enable NAME', and cost next to nothing in hot code until then. An armed
+named breakpoint stops in the GDB console right away.
 """
 
 import os
 import sys
 import logging
 import signal
-import time
 import threading
 import _pygdb
 
 enabled = False
 gdb_logger = None
-console_connected = None
 breakpoint_lock = threading.Lock()
 
 
@@ -58,27 +61,26 @@ def handle_sigcont(signalNumber, frame):
     """ NOTE: We do not forward SIGCONT because: 
     You can set a handler, but SIGCONT always makes the process continue regardless:
     https://www.gnu.org/software/libc/manual/html_node/Job-Control-Signals.html 
+
+    The waiting threads are released by the C handler of _pygdb, which
+    keeps the attached state, so this only logs the signal.
     """
-    global console_connected
-    breakpoint_lock.acquire()
-    if not console_connected:
-        console_connected = True
-        log("GDB console attached")
-    breakpoint_lock.release()
+    log("GDB console attached")
 
 
 def enable(logger=None):
     """Enable breakpoint"""
     global enabled
-    global console_connected
     global breakpoint_lock
 
     breakpoint_lock.acquire()
     if not enabled:
         enabled = True
-        console_connected = False
         set_logger(logger)
         signal.signal(signal.SIGCONT, handle_sigcont)
+        # NOTE: Python signal handlers only run in the main thread, so the
+        # waiting threads are woken by a C handler chained before it
+        _pygdb.enable_console_wakeup()
         log("enabled")
     breakpoint_lock.release()
 
@@ -114,21 +116,27 @@ def set_logger(logger):
     return result
 
 
-def set(logger=None):
-    """Used to set breakpoint, busy-wait until gdb console is connected"""
-    if not enabled:
+def set(logger=None, name=None):
+    """Used to set breakpoint, blocks until gdb console is connected.
+    A breakpoint with a *name* is skipped unless armed from the gdb console"""
+    if name is not None:
+        # Checked and counted in C, see py-info-named in the gdb console
+        if not _pygdb.is_armed(name):
+            return
+        _pygdb.breakpoint_mark()
         return
 
-    global console_connected
+    if not enabled:
+        return
 
-    # Wait for gdb console
-    breakpoint_lock.acquire()
     if logger is not None:
+        breakpoint_lock.acquire()
         set_logger(logger)
-    while not console_connected:
-        log("breakpoint.set: waiting for gdb console")
         breakpoint_lock.release()
-        time.sleep(1)
-        breakpoint_lock.acquire()
-    breakpoint_lock.release()
+
+    # Wait for gdb console
+    if not _pygdb.is_console_attached():
+        log("breakpoint.set: waiting for gdb console")
+        _pygdb.wait_console()
+        log("breakpoint.set: gdb console attached")
     _pygdb.breakpoint_mark()
@@ -28,15 +28,20 @@
 """Python gdb console commands"""
 
 import re
+import sys
 import gdb
+from contextlib import contextmanager
 from pygdb.console.core import Frame, move_in_stack, \
     PyObjectPtr, PyDictObjectPtr, PyInstanceObjectPtr, HeapTypeObjectPtr, \
     MAX_OUTPUT_LEN
 
-from pygdb.console.extensions import attach, \
+from pygdb.console.extensions import attach, detach, \
     breakpoint_continue, breakpoint_list, \
     get_pyobject_value, inject_pyframe, inspect_pyframe, \
-    list_pyframe, pystep, pynext, set_pyframe_local, switch_thread
+    list_pyframe, pystep, pynext, pyfinish, set_pyframe_local, \
+    switch_thread, backtrace_all_threads, backtrace_pyframes, \
+    select_pyframe_index, add_pybreak, delete_pybreak, list_pybreaks, \
+    arm_named_breakpoint, list_named_breakpoints
 
 commands = None
 
@@ -62,11 +67,18 @@ def register():
         cmd_py_detach('py-detach'),
         cmd_py_thread('py-thread'),
         cmd_py_breakpoint('py-breakpoint'),
+        cmd_py_break('py-break'),
+        cmd_py_info_named('py-info-named'),
+        cmd_py_enable('py-enable'),
+        cmd_py_disable('py-disable'),
         cmd_py_step('py-step'),
         cmd_py_next('py-next'),
+        cmd_py_finish('py-finish'),
         cmd_py_continue('py-continue'),
         cmd_py_list('py-list'),
         cmd_py_backtrace('py-backtrace'),
+        cmd_py_backtrace_all('py-backtrace-all'),
+        cmd_py_frame('py-frame'),
         cmd_py_inspect_frame('py-inspect-frame'),
         cmd_py_builtins('py-builtins'),
         cmd_py_globals('py-globals'),
@@ -79,6 +91,50 @@ def register():
     ]
 
 
+def parse_output_args(args):
+    """
+    Split the output options off the command arguments, in any position:
+        --maxlen N   truncate values after N characters (0 for no limit)
+        --file PATH  write the output to PATH instead of the console
+    Returns (maxlen, path, remaining args) and raises ValueError on a
+    missing or bad option value, e.g. a negative maxlen
+    """
+    maxlen = MAX_OUTPUT_LEN
+    path = None
+    args = str(args)
+    while True:
+        m = re.search(r'(?:^|\s)--(maxlen|file)(?:\s+(\S+)|\s*$)', args)
+        if not m:
+            break
+        if m.group(2) is None:
+            raise ValueError("missing value for --%s" % m.group(1))
+        if m.group(1) == 'maxlen':
+            maxlen = int(m.group(2))
+            if maxlen < 0:
+                raise ValueError("negative --maxlen: %d" % maxlen)
+        else:
+            path = m.group(2)
+        args = args[:m.start()] + ' ' + args[m.end():]
+    return (maxlen, path, args.strip())
+
+
+@contextmanager
+def output_stream(path):
+    """Yields sys.stdout, or the file PATH opened for writing if given"""
+    if path is None:
+        yield sys.stdout
+    else:
+        with open(path, 'w') as out:
+            yield out
+
+
+def write_value(out, prefix, pyop_value, maxlen):
+    """Stream "prefix" and the truncated repr of pyop_value to out"""
+    out.write(prefix)
+    pyop_value.write_truncated_repr(out, maxlen)
+    out.write('\n')
+
+
 class cmd_py_info_procs(gdb.Command):
     """Display list of attached processes"""
 
@@ -204,7 +260,7 @@ class cmd_py_detach(gdb.Command):
         except:
             self.help()
             return
-        gdb.execute("detach inferior %d" % num)
+        detach(num)
 
 
 class cmd_py_thread(gdb.Command):
@@ -272,6 +328,139 @@ class cmd_py_breakpoint(gdb.Command):
         breakpoint_list(threadid=threadid)
 
 
+class cmd_py_break(gdb.Command):
+    """Stop all threads at a python source line, without editing the code
+    FILE may be a trailing part of the path, e.g. pkg/module.py:42,
+    matched against co_filename, which may be relative to the process cwd
+    Without arguments the breakpoints are listed
+    Use option:
+        --delete N
+    to delete breakpoint number N"""
+
+    name = None
+
+    def __init__(self, name):
+        self.name = name
+        gdb.Command.__init__(self,
+                             self.name,
+                             gdb.COMMAND_BREAKPOINTS,
+                             gdb.COMPLETE_FILENAME)
+
+    def help(self):
+        print "USAGE: %s [FILE:LINE | --delete N]" % self.name
+        print ""
+        doc_arr = self.__doc__.split('\n')
+        for ent in doc_arr:
+            print ent.strip()
+
+    def invoke(self, args, from_tty):
+        args = str(args).strip()
+        if args == "--help":
+            self.help()
+            return
+        if not args:
+            list_pybreaks()
+            return
+
+        m = re.match(r'--delete\s+(\d+)$', args)
+        if m:
+            if not delete_pybreak(int(m.group(1))):
+                print "No python breakpoint number %s" % m.group(1)
+            return
+        try:
+            number = add_pybreak(args)
+        except ValueError:
+            self.help()
+            return
+        if number is not None:
+            print "Python breakpoint %d at %s" % (number, args)
+
+
+class cmd_py_info_named(gdb.Command):
+    """Display the named breakpoints reached so far, whether armed, and how often reached"""
+
+    name = None
+
+    def __init__(self, name):
+        self.name = name
+        gdb.Command.__init__(self,
+                             self.name,
+                             gdb.COMMAND_BREAKPOINTS,
+                             gdb.COMPLETE_COMMAND)
+
+    def help(self):
+        print "USAGE: %s" % self.name
+        print ""
+        doc_arr = self.__doc__.split('\n')
+        for ent in doc_arr:
+            print ent.strip()
+
+    def invoke(self, args, from_tty):
+        if str(args) == "--help":
+            self.help()
+            return
+        list_named_breakpoints()
+
+
+class cmd_py_enable(gdb.Command):
+    """Arm the named breakpoint NAME, or all of them with '*'
+    NAME may be one the process hasn't reached yet (see py-info-named)
+    The gdb breakpoint armed names stop at is added if missing"""
+
+    name = None
+
+    def __init__(self, name):
+        self.name = name
+        gdb.Command.__init__(self,
+                             self.name,
+                             gdb.COMMAND_BREAKPOINTS,
+                             gdb.COMPLETE_COMMAND)
+
+    def help(self):
+        print "USAGE: %s NAME" % self.name
+        print ""
+        doc_arr = self.__doc__.split('\n')
+        for ent in doc_arr:
+            print ent.strip()
+
+    def invoke(self, args, from_tty):
+        args = str(args).strip()
+        if not args or args == "--help":
+            self.help()
+            return
+        if not arm_named_breakpoint(args, armed=True):
+            print "Unable to arm named breakpoint: %s" % args
+
+
+class cmd_py_disable(gdb.Command):
+    """Disarm the named breakpoint NAME, or all of them with '*'
+    Names are known once the breakpoint has been reached (see py-info-named)"""
+
+    name = None
+
+    def __init__(self, name):
+        self.name = name
+        gdb.Command.__init__(self,
+                             self.name,
+                             gdb.COMMAND_BREAKPOINTS,
+                             gdb.COMPLETE_COMMAND)
+
+    def help(self):
+        print "USAGE: %s NAME" % self.name
+        print ""
+        doc_arr = self.__doc__.split('\n')
+        for ent in doc_arr:
+            print ent.strip()
+
+    def invoke(self, args, from_tty):
+        args = str(args).strip()
+        if not args or args == "--help":
+            self.help()
+            return
+        if not arm_named_breakpoint(args, armed=False):
+            print "No named breakpoint: %s" % args
+
+
 class cmd_py_step(gdb.Command):
     """Continue until control reaches a different python source line"""
 
@@ -332,6 +521,33 @@ class cmd_py_next(gdb.Command):
         pynext(file_prefix=file_prefix)
 
 
+class cmd_py_finish(gdb.Command):
+    """Continue until the current python frame returns and display the returned value"""
+
+    name = None
+
+    def __init__(self, name):
+        self.name = name
+        gdb.Command.__init__(self,
+                             self.name,
+                             gdb.COMMAND_DATA,
+                             gdb.COMPLETE_COMMAND)
+
+    def help(self):
+        print "USAGE: %s" % self.name
+        print ""
+        doc_arr = self.__doc__.split('\n')
+        for ent in doc_arr:
+            print ent.strip()
+
+    def invoke(self, args, from_tty):
+        if str(args) == "--help":
+            self.help()
+            return
+
+        pyfinish()
+
+
 class cmd_py_continue(gdb.Command):
     """Continue until next python breakpoint and display code"""
 
@@ -406,7 +622,17 @@ class cmd_py_list(gdb.Command):
 
 
 class cmd_py_backtrace(gdb.Command):
-    """Display current python frame and all the frames within its call stack (if any)"""
+    """Display current python frame and all the frames within its call stack (if any)
+
+    Use options:
+        --maxlen N
+    to truncate each value after N characters (0 for no limit)
+        --file PATH
+    to write the output to PATH instead of the console
+        --fast
+    to read the python frames from the thread state in memory instead of
+    unwinding the native stack, numbered as used by py-frame
+    """
 
     name = None
 
@@ -418,7 +644,7 @@ class cmd_py_backtrace(gdb.Command):
                              gdb.COMPLETE_COMMAND)
 
     def help(self):
-        print "USAGE: %s" % self.name
+        print "USAGE: %s [--maxlen N] [--file PATH] [--fast]" % self.name
         print ""
         doc_arr = self.__doc__.split('\n')
         for ent in doc_arr:
@@ -428,12 +654,99 @@ class cmd_py_backtrace(gdb.Command):
         if str(args) == "--help":
             self.help()
             return
+        try:
+            (maxlen, path, args) = parse_output_args(args)
+        except ValueError:
+            self.help()
+            return
 
-        frame = Frame.get_selected_python_frame()
-        while frame:
-            if frame.is_evalframeex():
-                frame.print_summary()
-            frame = frame.older()
+        options = args.split()
+        fast = '--fast' in options
+        if [option for option in options if option != '--fast']:
+            self.help()
+            return
+
+        with output_stream(path) as out:
+            if fast and backtrace_pyframes(maxlen, out):
+                return
+            frame = Frame.get_selected_python_frame()
+            while frame:
+                if frame.is_evalframeex():
+                    frame.print_summary(maxlen, out)
+                frame = frame.older()
+
+
+class cmd_py_backtrace_all(gdb.Command):
+    """Display the python call stack of all threads, grouping threads with identical stacks
+
+    Use option:
+        --file PATH
+    to write the output to PATH instead of the console
+    """
+
+    name = None
+
+    def __init__(self, name):
+        self.name = name
+        gdb.Command.__init__(self,
+                             self.name,
+                             gdb.COMMAND_STACK,
+                             gdb.COMPLETE_COMMAND)
+
+    def help(self):
+        print "USAGE: %s [--file PATH]" % self.name
+        print ""
+        doc_arr = self.__doc__.split('\n')
+        for ent in doc_arr:
+            print ent.strip()
+
+    def invoke(self, args, from_tty):
+        if str(args) == "--help":
+            self.help()
+            return
+        try:
+            (_, path, args) = parse_output_args(args)
+        except ValueError:
+            self.help()
+            return
+        if args:
+            self.help()
+            return
+
+        with output_stream(path) as out:
+            if not backtrace_all_threads(out):
+                print "Unable to find the python thread states"
+
+
+class cmd_py_frame(gdb.Command):
+    """Select and display code for python frame N as numbered by py-backtrace --fast"""
+
+    name = None
+
+    def __init__(self, name):
+        self.name = name
+        gdb.Command.__init__(self,
+                             self.name,
+                             gdb.COMMAND_STACK,
+                             gdb.COMPLETE_COMMAND)
+
+    def help(self):
+        print "USAGE: %s N" % self.name
+        print ""
+        doc_arr = self.__doc__.split('\n')
+        for ent in doc_arr:
+            print ent.strip()
+
+    def invoke(self, args, from_tty):
+        args = str(args).strip()
+        if args == "--help" or not args.isdigit():
+            self.help()
+            return
+
+        if select_pyframe_index(int(args)):
+            list_pyframe()
+        else:
+            print "Unable to find python frame %s" % args
 
 
 class cmd_py_inspect_frame(gdb.Command):
@@ -464,7 +777,14 @@ class cmd_py_inspect_frame(gdb.Command):
 
 
 class cmd_py_builtins(gdb.Command):
-    """Display builtin varialbes for current python frame"""
+    """Display builtin varialbes for current python frame
+
+    Use options:
+        --maxlen N
+    to truncate each value after N characters (0 for no limit)
+        --file PATH
+    to write the output to PATH instead of the console
+    """
 
     name = None
 
@@ -476,7 +796,7 @@ class cmd_py_builtins(gdb.Command):
                              gdb.COMPLETE_COMMAND)
 
     def help(self):
-        print "USAGE: %s" % self.name
+        print "USAGE: %s [--maxlen N] [--file PATH]" % self.name
         print ""
         doc_arr = self.__doc__.split('\n')
         for ent in doc_arr:
@@ -486,6 +806,14 @@ class cmd_py_builtins(gdb.Command):
         if str(args) == "--help":
             self.help()
             return
+        try:
+            (maxlen, path, args) = parse_output_args(args)
+        except ValueError:
+            self.help()
+            return
+        if args:
+            self.help()
+            return
 
         frame = Frame.get_selected_python_frame()
         if not frame:
@@ -497,14 +825,21 @@ class cmd_py_builtins(gdb.Command):
             print "Unable to read information on python frame"
             return
 
-        for pyop_name, pyop_value in pyop_frame.iter_builtins():
-            print('%s = %s'
-                  % (pyop_name.proxyval(set()),
-                      pyop_value.get_truncated_repr(MAX_OUTPUT_LEN)))
+        with output_stream(path) as out:
+            for pyop_name, pyop_value in pyop_frame.iter_builtins():
+                write_value(out, '%s = ' % pyop_name.proxyval(set()),
+                            pyop_value, maxlen)
 
 
 class cmd_py_globals(gdb.Command):
-    """Display global variables for current python frame"""
+    """Display global variables for current python frame
+
+    Use options:
+        --maxlen N
+    to truncate each value after N characters (0 for no limit)
+        --file PATH
+    to write the output to PATH instead of the console
+    """
 
     name = None
 
@@ -516,7 +851,7 @@ class cmd_py_globals(gdb.Command):
                              gdb.COMPLETE_COMMAND)
 
     def help(self):
-        print "USAGE: %s" % self.name
+        print "USAGE: %s [--maxlen N] [--file PATH]" % self.name
         print ""
         doc_arr = self.__doc__.split('\n')
         for ent in doc_arr:
@@ -526,6 +861,14 @@ class cmd_py_globals(gdb.Command):
         if str(args) == "--help":
             self.help()
             return
+        try:
+            (maxlen, path, args) = parse_output_args(args)
+        except ValueError:
+            self.help()
+            return
+        if args:
+            self.help()
+            return
 
         frame = Frame.get_selected_python_frame()
         if not frame:
@@ -537,14 +880,21 @@ class cmd_py_globals(gdb.Command):
             print "Unable to read information on python frame"
             return
 
-        for pyop_name, pyop_value in pyop_frame.iter_globals():
-            print('%s = %s'
-                  % (pyop_name.proxyval(set()),
-                      pyop_value.get_truncated_repr(MAX_OUTPUT_LEN)))
+        with output_stream(path) as out:
+            for pyop_name, pyop_value in pyop_frame.iter_globals():
+                write_value(out, '%s = ' % pyop_name.proxyval(set()),
+                            pyop_value, maxlen)
 
 
 class cmd_py_locals(gdb.Command):
-    """Display local variables for current python frame"""
+    """Display local variables for current python frame
+
+    Use options:
+        --maxlen N
+    to truncate each value after N characters (0 for no limit)
+        --file PATH
+    to write the output to PATH instead of the console
+    """
 
     name = None
 
@@ -556,7 +906,7 @@ class cmd_py_locals(gdb.Command):
                              gdb.COMPLETE_COMMAND)
 
     def help(self):
-        print "USAGE: %s" % self.name
+        print "USAGE: %s [--maxlen N] [--file PATH]" % self.name
         print ""
         doc_arr = self.__doc__.split('\n')
         for ent in doc_arr:
@@ -566,6 +916,14 @@ class cmd_py_locals(gdb.Command):
         if str(args) == "--help":
             self.help()
             return
+        try:
+            (maxlen, path, args) = parse_output_args(args)
+        except ValueError:
+            self.help()
+            return
+        if args:
+            self.help()
+            return
 
         frame = Frame.get_selected_python_frame()
         if not frame:
@@ -577,10 +935,10 @@ class cmd_py_locals(gdb.Command):
             print "Unable to read information on python frame"
             return
 
-        for pyop_name, pyop_value in pyop_frame.iter_locals():
-            print('%s = %s'
-                  % (pyop_name.proxyval(set()),
-                      pyop_value.get_truncated_repr(MAX_OUTPUT_LEN)))
+        with output_stream(path) as out:
+            for pyop_name, pyop_value in pyop_frame.iter_locals():
+                write_value(out, '%s = ' % pyop_name.proxyval(set()),
+                            pyop_value, maxlen)
 
 
 class cmd_py_print(gdb.Command):
@@ -594,6 +952,17 @@ class cmd_py_print(gdb.Command):
     Use argument:
         x.y
     to display value y for dictionary/object variable x
+
+    Use argument:
+        x['key'] or x[3]
+    to display the value for a key of dictionary x or an index of
+    list/tuple x
+
+    Use options:
+        --maxlen N
+    to truncate each value after N characters (0 for no limit)
+        --file PATH
+    to write the output to PATH instead of the console
     """
 
     name = None
@@ -605,15 +974,22 @@ class cmd_py_print(gdb.Command):
                              gdb.COMPLETE_COMMAND)
 
     def help(self):
-        print "USAGE: %s" % self.name
+        print "USAGE: %s [--maxlen N] [--file PATH] NAME" % self.name
         print ""
         doc_arr = self.__doc__.split('\n')
         for ent in doc_arr:
             print ent.strip()
 
     def invoke(self, args, from_tty):
-        name = str(args)
-        if name == "--help":
+        if str(args) == "--help":
+            self.help()
+            return
+        try:
+            (maxlen, path, name) = parse_output_args(args)
+        except ValueError:
+            self.help()
+            return
+        if not name:
             self.help()
             return
 
@@ -626,20 +1002,19 @@ class cmd_py_print(gdb.Command):
                 value_dict = value.pyop_field('in_dict')
             elif isinstance(value, HeapTypeObjectPtr):
                 value_dict = value.get_attr_dict()
-            if value_dict:
-                print "------------------------------------------------------------------------------"
-                print "(%s) %s:" % (scope, name)
-                print "------------------------------------------------------------------------------"
-                for key, val in value_dict.iteritems():
-                    if isinstance(key, PyObjectPtr):
-                        key = key.get_truncated_repr(MAX_OUTPUT_LEN)
-                    print "%s = %s" % (key, val.get_truncated_repr(MAX_OUTPUT_LEN))
-                print "------------------------------------------------------------------------------"
-            else:
-                print "(%s) %s = %s" \
-                    % (scope,
-                       name,
-                       value.get_truncated_repr(MAX_OUTPUT_LEN))
+            with output_stream(path) as out:
+                if value_dict:
+                    out.write("------------------------------------------------------------------------------\n")
+                    out.write("(%s) %s:\n" % (scope, name))
+                    out.write("------------------------------------------------------------------------------\n")
+                    for key, val in value_dict.iteritems():
+                        if isinstance(key, PyObjectPtr):
+                            key = key.get_truncated_repr(maxlen)
+                        write_value(out, "%s = " % key, val, maxlen)
+                    out.write("------------------------------------------------------------------------------\n")
+                else:
+                    write_value(out, "(%s) %s = " % (scope, name),
+                                value, maxlen)
         else:
             print "%r not found" % name
 
@@ -68,22 +68,26 @@
 # We try to defer gdb.lookup_type() invocations for python types until as late as
 # possible: for a dynamically linked python binary, when the process starts in
 # the debugger, the libpython.so hasn't been dynamically loaded yet, so none of
-# the type names are known to the debugger
+# the type names are known to the debugger.  The types and struct layouts are
+# resolved once, when libpython is loaded (see LayoutRegistry), and the hot
+# paths only read from the registry
 #
 # The module also extends gdb with some python-specific commands.
 #
 
 """GDB console python core functions"""
 
+import os
+import re
 import sys
+import array
+import bisect
+import struct
+import itertools
 import gdb
 
 # Look up the gdb.Type for some standard types:
-_type_char_ptr = gdb.lookup_type('char').pointer()  # char*
-_type_unsigned_char_ptr = gdb.lookup_type(
-    'unsigned char').pointer()  # unsigned char*
 _type_void_ptr = gdb.lookup_type('void').pointer()  # void*
-_type_size_t = gdb.lookup_type('size_t')
 
 SIZEOF_VOID_P = _type_void_ptr.sizeof
 
@@ -101,8 +105,14 @@ Py_TPFLAGS_BASE_EXC_SUBCLASS = (1L << 30)
 Py_TPFLAGS_TYPE_SUBCLASS = (1L << 31)
 
 
+# Default maximum length of the repr of a value; commands accept
+# --maxlen to override it and 0 means unlimited
 MAX_OUTPUT_LEN = 1024
 
+# Upper bound for the size of a single bulk read of object data (e.g. the
+# bytes of a string), guarding against corrupt sizes in the inferior
+MAX_READ_SIZE = 64 * 1024 * 1024
+
 
 class NullPyObjectPtr(RuntimeError):
     pass
@@ -115,10 +125,413 @@ def safety_limit(val):
     return min(val, 1000)
 
 
-def safe_range(val):
-    # As per range, but don't trust the value too much: cap it to a safety
-    # threshold in case the data was corrupted
-    return xrange(safety_limit(val))
+class MemoryCache(object):
+    """
+    Page granular LRU cache of inferior memory.
+
+    While the inferior is stopped its memory doesn't change (except through
+    our own writes), so all reads during one stop are served from whole
+    pages fetched once. This matters most for remote targets (gdbserver)
+    where every read is a round trip.
+
+    The cache is flushed when the inferior is resumed or exits (see
+    connect_events) and after writes made by the console (flush). Each
+    flush starts a new stop "epoch", which other caches use to tell if
+    what they know about the inferior might be stale.
+
+    LRU order is approximated with two generations of plain dicts, which
+    keeps hits as cheap as a dict lookup: pages used since the last
+    generation change are "hot", and when the hot generation is full the
+    old one, holding the least recently used pages, is dropped.
+    """
+
+    def __init__(self, page_size=4096, max_pages=4096):
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self._hot = {}
+        self._old = {}
+
+    def flush(self, event=None):
+        """Drop all cached pages and start a new stop epoch"""
+        self._hot = {}
+        self._old = {}
+        self.epoch += 1
+
+    def stats(self):
+        return {'epoch': self.epoch,
+                'pages': len(self._hot) + len(self._old),
+                'hits': self.hits,
+                'misses': self.misses}
+
+    def _read_page(self, page):
+        data = self._hot.get(page)
+        if data is not None:
+            self.hits += 1
+            return data
+        data = self._old.pop(page, None)
+        if data is None:
+            self.misses += 1
+            data = str(gdb.selected_inferior().read_memory(page,
+                                                           self.page_size))
+        else:
+            self.hits += 1
+        if len(self._hot) >= self.max_pages // 2:
+            self._old = self._hot
+            self._hot = {}
+        self._hot[page] = data
+        return data
+
+    def read(self, address, length):
+        """Read *length* bytes at *address*, see read_memory"""
+        page_size = self.page_size
+        first_page = address - address % page_size
+        end = address + length
+        offset = address - first_page
+        if end <= first_page + page_size:
+            data = self._hot.get(first_page)
+            if data is not None:
+                # Fast path: a hit within a single page
+                self.hits += 1
+                return data[offset:offset + length]
+        if end - first_page > self.max_pages * page_size // 4:
+            # Don't let a single huge read (e.g. a big string) flush the
+            # whole cache
+            self.misses += 1
+            return str(gdb.selected_inferior().read_memory(address, length))
+        try:
+            page = first_page
+            chunks = []
+            while page < end:
+                chunks.append(self._read_page(page))
+                page += page_size
+        except gdb.MemoryError:
+            # Part of a page isn't readable, e.g. the end of a mapping in
+            # a core file: read exactly what was asked for
+            return str(gdb.selected_inferior().read_memory(address, length))
+        if len(chunks) == 1:
+            return chunks[0][offset:offset + length]
+        return ''.join(chunks)[offset:offset + length]
+
+
+memory_cache = MemoryCache()
+
+
+def read_memory(address, length):
+    """
+    Read *length* bytes at *address* from the inferior process with a single
+    memory transfer (or none, when served by the memory_cache) and return
+    them as a str
+    """
+    if length <= 0:
+        return ''
+    return memory_cache.read(address, length)
+
+
+def read_string(address, maxlen=1024):
+    """
+    Read a NUL-terminated C string at *address* from the inferior process.
+    The string is fetched in chunks that never cross a page boundary, so a
+    short string at the end of a mapping doesn't fail the read
+    """
+    if address == 0:
+        raise NullPyObjectPtr(address)
+    chunks = []
+    while maxlen > 0:
+        length = min(maxlen, 4096 - (address % 4096))
+        chunk = read_memory(address, length)
+        end = chunk.find('\0')
+        if end >= 0:
+            chunks.append(chunk[:end])
+            break
+        chunks.append(chunk)
+        address += length
+        maxlen -= length
+    return ''.join(chunks)
+
+
+def read_array(address, fmt, count):
+    """
+    Read *count* contiguous elements with the struct format character *fmt*
+    (see StructLayout) at *address* and return them as a tuple
+    """
+    if count <= 0:
+        return ()
+    size = struct.calcsize(fmt)
+    data = read_memory(address, count * size)
+    return struct.unpack('%s%d%s' % (get_byteorder(), count, fmt), data)
+
+
+def read_pointers(address, count):
+    """
+    Read a vector of *count* pointers at *address* with a single memory read
+    and return the addresses as a sequence (an array.array when possible,
+    which decodes the whole vector at once)
+    """
+    if count <= 0 or _POINTER_TYPECODE is None:
+        return read_array(address, _POINTER_FORMAT, count)
+    pointers = array.array(_POINTER_TYPECODE,
+                           read_memory(address, count * SIZEOF_VOID_P))
+    if get_byteorder() != _NATIVE_BYTEORDER:
+        pointers.byteswap()
+    return pointers
+
+
+def write_memory(address, data):
+    """
+    Write the str *data* to the inferior process at *address*. Everything
+    read through the memory_cache before is dropped.
+    """
+    gdb.selected_inferior().write_memory(address, data)
+    memory_cache.flush()
+
+
+def write_scalar(address, fmt, value):
+    """Write *value* with the struct format character *fmt* at *address*"""
+    write_memory(address, struct.pack(get_byteorder() + fmt, value))
+
+
+def write_pointer(address, value):
+    """Write the pointer *value* at *address*"""
+    write_scalar(address, _POINTER_FORMAT, value)
+
+
+_POINTER_FORMAT = {4: 'I', 8: 'Q'}[SIZEOF_VOID_P]
+_POINTER_TYPECODE = ([typecode for typecode in 'ILQ'
+                      if typecode in getattr(array, 'typecodes', 'IL')
+                      and array.array(typecode).itemsize == SIZEOF_VOID_P]
+                     + [None])[0]
+_NATIVE_BYTEORDER = {'little': '<', 'big': '>'}[sys.byteorder]
+_INT_FORMATS = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+_FLOAT_FORMATS = {4: 'f', 8: 'd'}
+
+
+def struct_format(gdbtype):
+    """
+    Get the struct format character for a scalar gdb.Type, or None if the
+    type can't be decoded as a single value (e.g. structs and functions)
+    """
+    gdbtype = gdbtype.strip_typedefs()
+    if gdbtype.code == gdb.TYPE_CODE_PTR:
+        return _POINTER_FORMAT
+    if gdbtype.code in (gdb.TYPE_CODE_INT, gdb.TYPE_CODE_ENUM,
+                        gdb.TYPE_CODE_CHAR, gdb.TYPE_CODE_BOOL):
+        fmt = _INT_FORMATS.get(gdbtype.sizeof)
+        if fmt and (gdbtype.code == gdb.TYPE_CODE_BOOL
+                    or str(gdbtype).startswith('unsigned')):
+            fmt = fmt.upper()
+        return fmt
+    if gdbtype.code == gdb.TYPE_CODE_FLT:
+        return _FLOAT_FORMATS.get(gdbtype.sizeof)
+    return None
+
+
+class StructLayout(object):
+    """
+    Byte offsets and precompiled struct formats for the fields of a C struct
+    in the inferior process, so that a whole struct can be fetched with one
+    read_memory call and its fields decoded locally.
+
+    Fields of embedded structs are flattened into the layout, e.g. the
+    "ob_base" of the python 3 PyObject_VAR_HEAD, so the same field names work
+    for python 2 and python 3 layouts. Array fields are decoded by their
+    element type.
+    """
+
+    def __init__(self, gdbtype, byteorder):
+        gdbtype = gdbtype.strip_typedefs()
+        self.name = str(gdbtype)
+        self.sizeof = gdbtype.sizeof
+        self.byteorder = byteorder
+        self._fields = {}
+        self._add_fields(gdbtype, 0, ())
+
+    def _add_fields(self, gdbtype, offset, path):
+        for field in gdbtype.fields():
+            if not field.name or getattr(field, 'bitsize', 0):
+                continue
+            field_offset = offset + field.bitpos // 8
+            field_path = path + (field.name,)
+            field_type = field.type.strip_typedefs()
+            if field_type.code == gdb.TYPE_CODE_ARRAY:
+                field_type = field_type.target().strip_typedefs()
+            fmt = struct_format(field_type)
+            if fmt:
+                unpacker = struct.Struct(self.byteorder + fmt)
+            else:
+                unpacker = None
+            if field.name not in self._fields:
+                self._fields[field.name] = (field_offset, unpacker, fmt,
+                                            field_path)
+            if field_type.code in (gdb.TYPE_CODE_STRUCT,
+                                   gdb.TYPE_CODE_UNION):
+                self._add_fields(field_type, field_offset, field_path)
+
+    def has_field(self, name):
+        return name in self._fields
+
+    def path(self, name):
+        """
+        Get the names leading to field *name* through embedded structs, e.g.
+        ('ob_base', 'ob_size') for a python 3 PyVarObject
+        """
+        self.offset(name)
+        return self._fields[name][3]
+
+    def offset(self, name):
+        """Get the byte offset of field *name* within the struct"""
+        try:
+            return self._fields[name][0]
+        except KeyError:
+            raise RuntimeError('There is no member named %s in %s.'
+                               % (name, self.name))
+
+    def format(self, name):
+        """Get the struct format character of (elements of) field *name*"""
+        self.offset(name)
+        return self._fields[name][2]
+
+    def _unpacker(self, name):
+        unpacker = self._fields[name][1]
+        if unpacker is None:
+            raise RuntimeError('Member %s of %s is not a scalar'
+                               % (name, self.name))
+        return unpacker
+
+    def unpack(self, data, name):
+        """Decode the value of field *name* from the struct bytes *data*"""
+        offset = self.offset(name)
+        return self._unpacker(name).unpack_from(data, offset)[0]
+
+    def read(self, address):
+        """Read the whole struct at *address* with a single memory read"""
+        return read_memory(address, self.sizeof)
+
+    def read_field(self, address, name):
+        """Read and decode field *name* of the struct at *address*"""
+        offset = self.offset(name)
+        unpacker = self._unpacker(name)
+        return unpacker.unpack(read_memory(address + offset,
+                                           unpacker.size))[0]
+
+    def write_field(self, address, name, value):
+        """Encode and write *value* to field *name* of the struct at
+        *address*"""
+        offset = self.offset(name)
+        write_memory(address + offset, self._unpacker(name).pack(value))
+
+    def read_array(self, address, name, count):
+        """
+        Read *count* elements of the array field *name* of the struct at
+        *address* (e.g. ob_item of a tuple) with a single memory read
+        """
+        return read_array(address + self.offset(name),
+                          self.format(name), count)
+
+
+class LayoutRegistry(object):
+    """
+    The gdb types, struct layouts and sizes of libpython needed by the
+    wrappers, resolved once per inferior instead of with gdb.lookup_type
+    calls in the hot paths.
+
+    The registry is loaded when an objfile providing libpython is loaded
+    (see connect_events), or on first use if that happened before this
+    module was loaded. Types that are not in the registry are resolved and
+    added on first use.
+    """
+
+    typenames = ('PyObject', 'PyVarObject', 'PyTypeObject',
+                 'PyBaseExceptionObject', 'PyBoolObject', 'PyClassObject',
+                 'PyCFunctionObject', 'PyMethodDef', 'PyCodeObject',
+                 'PyDictObject', 'PyDictEntry', 'PyInstanceObject',
+                 'PyIntObject', 'PyListObject', 'PyLongObject',
+                 'PyFrameObject', 'PySetObject', 'setentry',
+                 'PyStringObject', 'PyTupleObject', 'PyUnicodeObject',
+                 'PyInterpreterState', 'PyThreadState')
+
+    def __init__(self):
+        self.loaded = False
+        self.byteorder = None
+        self.digit_size = None
+        self.unicode_width = None
+        self._layouts = {}
+        self._pointer_types = {}
+
+    def load(self):
+        """Resolve all types, layouts and sizes; raises RuntimeError if
+        libpython isn't known to gdb (yet)"""
+        self.reset()
+        if 'big endian' in gdb.execute('show endian', to_string=True):
+            self.byteorder = '>'
+        else:
+            self.byteorder = '<'
+        # Fail early (and stay unloaded) if there is no libpython at all:
+        gdb.lookup_type('PyObject')
+        for typename in self.typenames:
+            try:
+                self.add(typename)
+            except RuntimeError:
+                # Not every type exists in every python version
+                pass
+        for name, typename in (('digit_size', 'digit'),
+                               ('unicode_width', 'Py_UNICODE')):
+            try:
+                setattr(self, name, gdb.lookup_type(typename).sizeof)
+            except RuntimeError:
+                pass
+        self.loaded = True
+
+    def reset(self):
+        """Forget everything, e.g. when the objfiles change"""
+        self.__init__()
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def add(self, typename):
+        """Resolve the C type named *typename* and add it to the registry"""
+        gdbtype = gdb.lookup_type(typename)
+        layout = StructLayout(gdbtype, self.byteorder)
+        self._pointer_types[typename] = gdbtype.pointer()
+        self._layouts[typename] = layout
+        return layout
+
+    def layout(self, typename):
+        """Get the StructLayout for the C type named *typename*"""
+        layout = self._layouts.get(typename)
+        if layout is None:
+            self.ensure_loaded()
+            layout = self._layouts.get(typename)
+            if layout is None:
+                layout = self.add(typename)
+        return layout
+
+    def pointer_type(self, typename):
+        """Get the gdb.Type for a pointer to the C type named *typename*"""
+        pointer_type = self._pointer_types.get(typename)
+        if pointer_type is None:
+            self.layout(typename)
+            pointer_type = self._pointer_types[typename]
+        return pointer_type
+
+
+layouts = LayoutRegistry()
+
+
+def get_layout(typename):
+    """Get the StructLayout for the C type named *typename*"""
+    return layouts.layout(typename)
+
+
+def get_byteorder():
+    """Get the struct byte order character matching the inferior process"""
+    if layouts.byteorder is None:
+        layouts.ensure_loaded()
+    return layouts.byteorder
 
 
 class StringTruncated(RuntimeError):
@@ -127,23 +540,52 @@ class StringTruncated(RuntimeError):
 
 class TruncatedStringIO(object):
     """Similar to cStringIO, but can truncate the output by raising a
-    StringTruncated exception"""
+    StringTruncated exception.
 
-    def __init__(self, maxlen=None):
-        self._val = ''
+    The written fragments are kept in a list and only joined by getvalue,
+    so the cost is linear in the output length. If a file-like *stream* is
+    given (e.g. sys.stdout, which gdb pages, or an open file) the fragments
+    are written straight to it instead of being kept"""
+
+    def __init__(self, maxlen=None, stream=None):
+        self._chunks = []
+        self._len = 0
         self.maxlen = maxlen
+        self.stream = stream
+
+    def _append(self, data):
+        self._len += len(data)
+        if self.stream is None:
+            self._chunks.append(data)
+        else:
+            self.stream.write(data)
 
     def write(self, data):
         if self.maxlen:
-            if len(data) + len(self._val) > self.maxlen:
+            if len(data) + self._len > self.maxlen:
                 # Truncation:
-                self._val += data[0:self.maxlen - len(self._val)]
+                self._append(data[0:self.maxlen - self._len])
                 raise StringTruncated()
 
-        self._val += data
+        self._append(data)
+
+    def remaining(self):
+        """Number of characters that can still be written before truncation,
+        or None if the output is unlimited"""
+        if self.maxlen:
+            return self.maxlen - self._len
+        return None
+
+    def __len__(self):
+        return self._len
 
     def getvalue(self):
-        return self._val
+        """Get the output written so far (empty when streaming)"""
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+        if self._chunks:
+            return self._chunks[0]
+        return ''
 
 
 class PyObjectPtr(object):
@@ -156,14 +598,44 @@ class PyObjectPtr(object):
 
     Note that at every stage the underlying pointer could be NULL, point
     to corrupt data, etc; this is the debugger, after all.
+
+    The wrapper can also be created from a plain *address* (see
+    from_address), in which case the gdb.Value is only created if needed.
+    Field values are decoded from a single read of the whole struct (see
+    read_field) rather than through per-field gdb.Value accesses.
+
+    Subclasses for containers don't implement proxyval and write_repr
+    themselves, but the generators _proxyval_steps and _repr_steps which
+    are driven by a Traversal, so that the object graph is walked with an
+    explicit stack rather than by recursion.
     """
+    __slots__ = ('_gdbval', '_address', '_data', '_type_info')
     _typename = 'PyObject'
 
-    def __init__(self, gdbval, cast_to=None):
-        if cast_to:
+    # Generator methods of container subclasses, see Traversal
+    _proxyval_steps = None
+    _repr_steps = None
+
+    def __init__(self, gdbval=None, cast_to=None, address=None,
+                 type_info=None):
+        if gdbval is not None and cast_to:
             self._gdbval = gdbval.cast(cast_to)
         else:
             self._gdbval = gdbval
+        self._address = address
+        self._data = None
+        self._type_info = type_info
+
+    def gdbval(self):
+        """Get the underlying gdb.Value, creating it from the address if
+        the wrapper was created with from_address"""
+        if self._gdbval is None:
+            if self._type_info and self._type_info.cls is type(self):
+                gdb_type = self._type_info.gdb_type()
+            else:
+                gdb_type = self.get_gdb_type()
+            self._gdbval = gdb.Value(self._address).cast(gdb_type)
+        return self._gdbval
 
     def field(self, name):
         """
@@ -178,33 +650,53 @@ class PyObjectPtr(object):
 
         In Python 3, this is defined as an embedded PyVarObject type thus:
            PyVarObject ob_base;
-        so that the "ob_size" field is located insize the "ob_base" field, and
-        the "ob_type" is most easily accessed by casting back to a (PyObject*).
+        so that the "ob_size" field is located insize the "ob_base" field.
+
+        The registered StructLayout knows the path to each field, so no
+        probing is needed to tell the two apart.
         """
         if self.is_null():
             raise NullPyObjectPtr(self)
 
-        if name == 'ob_type':
-            pyo_ptr = self._gdbval.cast(PyObjectPtr.get_gdb_type())
-            return pyo_ptr.dereference()[name]
+        value = self.gdbval().dereference()
+        for component in self.get_layout().path(name):
+            value = value[component]
+        return value
 
-        if name == 'ob_size':
-            try:
-                # Python 2:
-                return self._gdbval.dereference()[name]
-            except RuntimeError:
-                # Python 3:
-                return self._gdbval.dereference()['ob_base'][name]
+    def read_struct(self):
+        """
+        Get the bytes of the whole struct this object points to, fetched
+        with a single memory read on first use
+        """
+        if self._data is None:
+            if self.is_null():
+                raise NullPyObjectPtr(self)
+            self._data = self.get_layout().read(self.as_address())
+        return self._data
 
-        # General case: look it up inside the object:
-        return self._gdbval.dereference()[name]
+    def read_field(self, name):
+        """
+        Get the value of the given scalar field within the PyObject, decoded
+        from the struct bytes (see read_struct). Pointer fields are returned
+        as addresses.
+        """
+        return self.get_layout().unpack(self.read_struct(), name)
+
+    def read_array_field(self, name, count):
+        """
+        Get the first *count* elements of the given array field within the
+        PyObject (e.g. ob_item of a tuple) with a single memory read
+        """
+        if self.is_null():
+            raise NullPyObjectPtr(self)
+        return self.get_layout().read_array(self.as_address(), name, count)
 
     def pyop_field(self, name):
         """
         Get a PyObjectPtr for the given PyObject* field within this PyObject,
         coping with some python 2 versus python 3 differences.
         """
-        return PyObjectPtr.from_pyobject_ptr(self.field(name))
+        return PyObjectPtr.from_address(self.read_field(name))
 
     def write_field_repr(self, name, out, visited):
         """
@@ -214,14 +706,17 @@ class PyObjectPtr(object):
         field_obj = self.pyop_field(name)
         field_obj.write_repr(out, visited)
 
-    def get_truncated_repr(self, maxlen):
+    def get_truncated_repr(self, maxlen, max_depth=None, max_items=None):
         """
         Get a repr-like string for the data, but truncate it at "maxlen" bytes
         (ending the object graph traversal as soon as you do)
+
+        Containers nested deeper than "max_depth" and items of a container
+        beyond the first "max_items" are elided as "..."
         """
         out = TruncatedStringIO(maxlen)
         try:
-            self.write_repr(out, set())
+            Traversal(None, max_depth, max_items).write_repr(self, out)
         except StringTruncated:
             # Truncation occurred:
             return out.getvalue() + '...(truncated)'
@@ -229,11 +724,29 @@ class PyObjectPtr(object):
         # No truncation occurred:
         return out.getvalue()
 
+    def write_truncated_repr(self, stream, maxlen, max_depth=None,
+                             max_items=None):
+        """
+        As get_truncated_repr, but write the repr to file-like object
+        "stream" as it's produced, without building the string in memory
+        """
+        out = TruncatedStringIO(maxlen, stream)
+        try:
+            Traversal(None, max_depth, max_items).write_repr(self, out)
+        except StringTruncated:
+            stream.write('...(truncated)')
+
     def type(self):
-        return PyTypeObjectPtr(self.field('ob_type'))
+        return PyTypeObjectPtr(address=self.read_field('ob_type'))
+
+    def type_info(self):
+        """Get the cached PyTypeInfo for the type of this object"""
+        if self._type_info is None:
+            self._type_info = get_type_info(self.read_field('ob_type'))
+        return self._type_info
 
     def is_null(self):
-        return 0 == long(self._gdbval)
+        return 0 == self.as_address()
 
     def is_optimized_out(self):
         """
@@ -245,11 +758,13 @@ class PyObjectPtr(object):
         See e.g. https://bugzilla.redhat.com/show_bug.cgi?id=556975 with
         PyEval_EvalFrameEx's "f"
         """
+        if self._gdbval is None:
+            return False
         return self._gdbval.is_optimized_out
 
     def safe_tp_name(self):
         try:
-            return self.type().field('tp_name').string()
+            return self.type_info().tp_name
         except NullPyObjectPtr:
             # NULL tp_name?
             return 'unknown'
@@ -273,39 +788,35 @@ class PyObjectPtr(object):
         visiting object graphs with loops).  Analogous to Py_ReprEnter and
         Py_ReprLeave
         """
-
-        class FakeRepr(object):
-            """
-            Class representing a non-descript PyObject* value in the inferior
-            process for when we don't have a custom scraper, intended to have
-            a sane repr().
-            """
-
-            def __init__(self, tp_name, address):
-                self.tp_name = tp_name
-                self.address = address
-
-            def __repr__(self):
-                # For the NULL pointer, we have no way of knowing a type, so
-                # special-case it as per
-                # http://bugs.python.org/issue8032#msg100882
-                if self.address == 0:
-                    return '0x0'
-                return '<%s at remote 0x%x>' % (self.tp_name, self.address)
+        if self._proxyval_steps is not None:
+            return Traversal(visited).proxyval(self)
 
         return FakeRepr(self.safe_tp_name(),
-                        long(self._gdbval))
+                        self.as_address())
 
     def write_repr(self, out, visited):
         """
         Write a string representation of the value scraped from the inferior
         process to "out", a file-like object.
         """
+        if self._repr_steps is not None:
+            return Traversal(visited).write_repr(self, out)
+
         # Default implementation: generate a proxy value and write its repr
         # However, this could involve a lot of work for complicated objects,
         # so for derived classes we specialize this
         return out.write(repr(self.proxyval(visited)))
 
+    def lazyval(self):
+        """
+        As proxyval, but containers (dicts, lists, tuples and instances) are
+        represented by lazy proxies, which only read the parts of the
+        object graph that are indexed, iterated or repr'd.
+
+        Derived classes for containers override this.
+        """
+        return self.proxyval(set())
+
     @classmethod
     def subclass_from_type(cls, t):
         """
@@ -326,8 +837,8 @@ class PyObjectPtr(object):
         flags
         """
         try:
-            tp_name = t.field('tp_name').string()
-            tp_flags = int(t.field('tp_flags'))
+            tp_name = t.tp_name()
+            tp_flags = t.read_field('tp_flags')
         except RuntimeError:
             # Handle any kind of error e.g. NULL ptrs by simply using the base
             # class
@@ -336,17 +847,8 @@ class PyObjectPtr(object):
         # print 'tp_flags = 0x%08x' % tp_flags
         # print 'tp_name = %r' % tp_name
 
-        name_map = {'bool': PyBoolObjectPtr,
-                    'classobj': PyClassObjectPtr,
-                    'instance': PyInstanceObjectPtr,
-                    'NoneType': PyNoneStructPtr,
-                    'frame': PyFrameObjectPtr,
-                    'set': PySetObjectPtr,
-                    'frozenset': PySetObjectPtr,
-                    'builtin_function_or_method': PyCFunctionObjectPtr,
-                    }
-        if tp_name in name_map:
-            return name_map[tp_name]
+        if tp_name in _tp_name_map:
+            return _tp_name_map[tp_name]
 
         if tp_flags & Py_TPFLAGS_HEAPTYPE:
             return HeapTypeObjectPtr
@@ -380,21 +882,81 @@ class PyObjectPtr(object):
         the pointer accordingly.
         """
         try:
-            p = PyObjectPtr(gdbval)
-            cls = cls.subclass_from_type(p.type())
-            return cls(gdbval, cast_to=cls.get_gdb_type())
+            address = long(gdbval)
+        except RuntimeError:
+            # e.g. an optimized out value; keep the gdb.Value around so that
+            # is_optimized_out can tell
+            return cls(gdbval)
+        return cls.from_address(address)
+
+    @classmethod
+    def from_address(cls, address):
+        """
+        As from_pyobject_ptr, but for a (PyObject*) given as an address, e.g.
+        decoded from a struct or pointer vector, without creating a gdb.Value
+        """
+        try:
+            p = PyObjectPtr(address=address)
+            type_info = p.type_info()
         except RuntimeError:
             # Handle any kind of error e.g. NULL ptrs by simply using the base
             # class
-            pass
-        return cls(gdbval)
+            return cls(address=address)
+        return type_info.wrapper(cls)(address=address, type_info=type_info)
+
+    @classmethod
+    def from_addresses(cls, addresses):
+        """
+        Yields a PyObjectPtr for each (PyObject*) address, as from_address.
+        Containers are usually homogeneous, so the type of the previous
+        object is reused without another type cache lookup when ob_type
+        matches.
+        """
+        last_type, last_info = None, None
+        for address in addresses:
+            try:
+                ob_type = PyObjectPtr(address=address).read_field('ob_type')
+                if ob_type != last_type:
+                    last_type, last_info = ob_type, get_type_info(ob_type)
+            except RuntimeError:
+                last_type = None
+                yield cls(address=address)
+                continue
+            yield last_info.wrapper(cls)(address=address, type_info=last_info)
 
     @classmethod
     def get_gdb_type(cls):
-        return gdb.lookup_type(cls._typename).pointer()
+        return layouts.pointer_type(cls._typename)
+
+    @classmethod
+    def get_layout(cls):
+        return get_layout(cls._typename)
 
     def as_address(self):
-        return long(self._gdbval)
+        if self._address is None:
+            self._address = long(self._gdbval)
+        return self._address
+
+
+class FakeRepr(object):
+    """
+    Class representing a non-descript PyObject* value in the inferior
+    process for when we don't have a custom scraper, intended to have
+    a sane repr().
+    """
+    __slots__ = ('tp_name', 'address')
+
+    def __init__(self, tp_name, address):
+        self.tp_name = tp_name
+        self.address = address
+
+    def __repr__(self):
+        # For the NULL pointer, we have no way of knowing a type, so
+        # special-case it as per
+        # http://bugs.python.org/issue8032#msg100882
+        if self.address == 0:
+            return '0x0'
+        return '<%s at remote 0x%x>' % (self.tp_name, self.address)
 
 
 class ProxyAlreadyVisited(object):
@@ -404,6 +966,7 @@ class ProxyAlreadyVisited(object):
 
     Analogous to the values emitted by the users of Py_ReprEnter and Py_ReprLeave
     """
+    __slots__ = ('_rep',)
 
     def __init__(self, rep):
         self._rep = rep
@@ -412,28 +975,121 @@ class ProxyAlreadyVisited(object):
         return self._rep
 
 
-def _write_instance_repr(out, visited, name, pyop_attrdict, address):
+class Traversal(object):
+    """
+    Walk of an object graph for proxyval or write_repr, using an explicit
+    stack of generators instead of recursion, so that deeply nested values
+    (linked nodes, parse trees) don't hit the recursion limit.
+
+    Container classes implement two generator methods taking the Traversal:
+
+    _repr_steps yields strings to write and PyObjectPtr children whose repr
+    goes in their place.
+
+    _proxyval_steps yields PyObjectPtr children and is sent back the proxy
+    of each; the first value yielded which isn't a PyObjectPtr is the
+    proxy of the container itself.
+
+    visited: the set of addresses already visited (see proxyval).
+    max_depth: containers nested deeper than this are elided (None for no
+    limit).
+    max_items: number of items shown per container (None for no limit).
+    """
+    __slots__ = ('visited', 'max_depth', 'max_items')
+
+    def __init__(self, visited=None, max_depth=None, max_items=None):
+        if visited is None:
+            visited = set()
+        self.visited = visited
+        self.max_depth = max_depth
+        self.max_items = max_items
+
+    def seen(self, pyop):
+        """Mark pyop as visited, telling if it was already"""
+        address = pyop.as_address()
+        if address in self.visited:
+            return True
+        self.visited.add(address)
+        return False
+
+    def too_many(self, index):
+        """Tell if the item at index is beyond the items budget"""
+        return self.max_items is not None and index >= self.max_items
+
+    def too_deep(self, depth):
+        return self.max_depth is not None and depth > self.max_depth
+
+    def write_repr(self, pyop, out):
+        """Write the repr of pyop to file-like object "out" """
+        stack = []
+        step = pyop
+        while True:
+            if not isinstance(step, PyObjectPtr):
+                out.write(step)
+            elif step._repr_steps is None:
+                step.write_repr(out, self.visited)
+            elif self.too_deep(len(stack)):
+                out.write('...')
+            else:
+                stack.append(step._repr_steps(self))
+
+            # Advance to the next step of the innermost unfinished container
+            while stack:
+                try:
+                    step = next(stack[-1])
+                    break
+                except StopIteration:
+                    stack.pop()
+            else:
+                return
+
+    def proxyval(self, pyop):
+        """Get the proxy of pyop"""
+        if pyop._proxyval_steps is None:
+            return pyop.proxyval(self.visited)
+        stack = [pyop._proxyval_steps(self)]
+        value = None
+        while True:
+            step = stack[-1].send(value)
+            value = None
+            if not isinstance(step, PyObjectPtr):
+                # The proxy of the innermost container is complete
+                stack.pop().close()
+                if not stack:
+                    return step
+                value = step
+            elif step._proxyval_steps is None:
+                value = step.proxyval(self.visited)
+            elif self.too_deep(len(stack)):
+                value = ProxyAlreadyVisited('...')
+            else:
+                stack.append(step._proxyval_steps(self))
+
+
+def _instance_repr_steps(walk, name, pyop_attrdict, address):
     """Shared code for use by old-style and new-style classes:
-    write a representation to file-like object 'out'"""
-    out.write('<')
-    out.write(name)
+    the _repr_steps of an instance"""
+    yield '<'
+    yield name
 
     # Write dictionary of instance attributes:
     if isinstance(pyop_attrdict, PyDictObjectPtr):
-        out.write('(')
-        first = True
-        for pyop_arg, pyop_val in pyop_attrdict.iteritems():
-            if not first:
-                out.write(', ')
-            first = False
-            out.write(pyop_arg.proxyval(visited))
-            out.write('=')
-            pyop_val.write_repr(out, visited)
-        out.write(')')
-    out.write(' at remote 0x%x>' % address)
+        yield '('
+        for i, (pyop_arg, pyop_val) in enumerate(pyop_attrdict.iteritems()):
+            if i > 0:
+                yield ', '
+            if walk.too_many(i):
+                yield '...'
+                break
+            yield pyop_arg.proxyval(walk.visited)
+            yield '='
+            yield pyop_val
+        yield ')'
+    yield ' at remote 0x%x>' % address
 
 
 class InstanceProxy(object):
+    __slots__ = ('cl_name', 'attrdict', 'address')
 
     def __init__(self, cl_name, attrdict, address):
         self.cl_name = cl_name
@@ -451,15 +1107,111 @@ class InstanceProxy(object):
                                             self.address)
 
 
-def _PyObject_VAR_SIZE(typeobj, nitems):
-    return ((typeobj.field('tp_basicsize') +
-             nitems * typeobj.field('tp_itemsize') +
+class LazyProxy(object):
+    """
+    Base class of the lazy proxies given by PyObjectPtr.lazyval, wrapping
+    a PyObjectPtr and reading its children from the inferior on demand
+    """
+    __slots__ = ('_pyop',)
+
+    def __init__(self, pyop):
+        self._pyop = pyop
+
+    def pyop(self):
+        """Get the PyObjectPtr this proxies"""
+        return self._pyop
+
+    def __repr__(self):
+        return self._pyop.get_truncated_repr(MAX_OUTPUT_LEN)
+
+
+class LazyDictProxy(LazyProxy):
+    """Lazy proxy of a dict: entries are looked up when indexed"""
+    __slots__ = ()
+
+    def __len__(self):
+        return self._pyop.read_field('ma_used')
+
+    def __getitem__(self, key):
+        pyop_value = self._pyop.get_item(key)
+        if pyop_value is None:
+            raise KeyError(key)
+        return pyop_value.lazyval()
+
+    def __contains__(self, key):
+        return self._pyop.get_item(key) is not None
+
+    def get(self, key, default=None):
+        pyop_value = self._pyop.get_item(key)
+        if pyop_value is None:
+            return default
+        return pyop_value.lazyval()
+
+    def iteritems(self):
+        for pyop_key, pyop_value in self._pyop.iteritems():
+            yield (pyop_key.lazyval(), pyop_value.lazyval())
+
+    def iterkeys(self):
+        for key, value in self._pyop.iter_entries():
+            yield PyObjectPtr.from_address(key).lazyval()
+
+    def itervalues(self):
+        for key, value in self._pyop.iter_entries():
+            yield PyObjectPtr.from_address(value).lazyval()
+
+    __iter__ = iterkeys
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+
+class LazySequenceProxy(LazyProxy):
+    """Lazy proxy of a list or tuple: items are read when indexed"""
+    __slots__ = ()
+
+    def __len__(self):
+        return self._pyop.read_field('ob_size')
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [pyop.lazyval()
+                    for pyop in PyObjectPtr.from_addresses(self._pyop[i])]
+        return PyObjectPtr.from_address(self._pyop[i]).lazyval()
+
+    def __iter__(self):
+        # Read the item pointers a window at a time
+        size = len(self)
+        for start in xrange(0, size, 1024):
+            for item in self[start:start + 1024]:
+                yield item
+
+
+class LazyInstanceProxy(LazyProxy):
+    """Lazy proxy of an instance: attributes are looked up when accessed"""
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        pyop_value = self._pyop.get_attr(name)
+        if pyop_value is None:
+            raise AttributeError(name)
+        return pyop_value.lazyval()
+
+
+def _PyObject_VAR_SIZE(type_info, nitems):
+    return ((type_info.tp_basicsize +
+             nitems * type_info.tp_itemsize +
              (SIZEOF_VOID_P - 1)
-             ) & ~(SIZEOF_VOID_P - 1)
-            ).cast(_type_size_t)
+             ) & ~(SIZEOF_VOID_P - 1))
 
 
 class HeapTypeObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PyObject'
 
     def get_attr_dict(self):
@@ -468,25 +1220,21 @@ class HeapTypeObjectPtr(PyObjectPtr):
         (or None if there's a problem)
         """
         try:
-            typeobj = self.type()
-            dictoffset = int_from_int(typeobj.field('tp_dictoffset'))
+            type_info = self.type_info()
+            dictoffset = type_info.tp_dictoffset
             if dictoffset != 0:
                 if dictoffset < 0:
-                    type_PyVarObject_ptr = gdb.lookup_type(
-                        'PyVarObject').pointer()
-                    tsize = int_from_int(self._gdbval.cast(
-                        type_PyVarObject_ptr)['ob_size'])
+                    tsize = get_layout('PyVarObject').read_field(
+                        self.as_address(), 'ob_size')
                     if tsize < 0:
                         tsize = -tsize
-                    size = _PyObject_VAR_SIZE(typeobj, tsize)
+                    size = _PyObject_VAR_SIZE(type_info, tsize)
                     dictoffset += size
                     assert dictoffset > 0
                     assert dictoffset % SIZEOF_VOID_P == 0
 
-                dictptr = self._gdbval.cast(_type_char_ptr) + dictoffset
-                PyObjectPtrPtr = PyObjectPtr.get_gdb_type().pointer()
-                dictptr = dictptr.cast(PyObjectPtrPtr)
-                return PyObjectPtr.from_pyobject_ptr(dictptr.dereference())
+                dictptr = read_pointers(self.as_address() + dictoffset, 1)[0]
+                return PyObjectPtr.from_address(dictptr)
         except RuntimeError:
             # Corrupt data somewhere; fail safe
             pass
@@ -494,7 +1242,20 @@ class HeapTypeObjectPtr(PyObjectPtr):
         # Not found, or some kind of error:
         return None
 
-    def proxyval(self, visited):
+    def get_attr(self, name):
+        """
+        Get the PyObjectPtr for attribute *name* from the attribute
+        dictionary, or None if there's no such attribute
+        """
+        pyop_attr_dict = self.get_attr_dict()
+        if isinstance(pyop_attr_dict, PyDictObjectPtr):
+            return pyop_attr_dict.get_item(name)
+        return None
+
+    def lazyval(self):
+        return LazyInstanceProxy(self)
+
+    def _proxyval_steps(self, walk):
         """
         Support for new-style classes.
 
@@ -502,32 +1263,32 @@ class HeapTypeObjectPtr(PyObjectPtr):
         python of _PyObject_GetDictPtr, ignoring descriptors
         """
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            return ProxyAlreadyVisited('<...>')
-        visited.add(self.as_address())
+        if walk.seen(self):
+            yield ProxyAlreadyVisited('<...>')
+            return
 
         pyop_attr_dict = self.get_attr_dict()
         if pyop_attr_dict:
-            attr_dict = pyop_attr_dict.proxyval(visited)
+            attr_dict = yield pyop_attr_dict
         else:
             attr_dict = {}
         tp_name = self.safe_tp_name()
 
         # New-style class:
-        return InstanceProxy(tp_name, attr_dict, long(self._gdbval))
+        yield InstanceProxy(tp_name, attr_dict, self.as_address())
 
-    def write_repr(self, out, visited):
+    def _repr_steps(self, walk):
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            out.write('<...>')
+        if walk.seen(self):
+            yield '<...>'
             return
-        visited.add(self.as_address())
 
         pyop_attrdict = self.get_attr_dict()
-        _write_instance_repr(out, visited,
-                             self.safe_tp_name(),
-                             pyop_attrdict,
-                             self.as_address())
+        for step in _instance_repr_steps(walk,
+                                         self.safe_tp_name(),
+                                         pyop_attrdict,
+                                         self.as_address()):
+            yield step
 
 
 class ProxyException(Exception):
@@ -544,26 +1305,26 @@ class PyBaseExceptionObjectPtr(PyObjectPtr):
     Class wrapping a gdb.Value that's a PyBaseExceptionObject* i.e. an exception
     within the process being debugged.
     """
+    __slots__ = ()
     _typename = 'PyBaseExceptionObject'
 
-    def proxyval(self, visited):
+    def _proxyval_steps(self, walk):
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            return ProxyAlreadyVisited('(...)')
-        visited.add(self.as_address())
-        arg_proxy = self.pyop_field('args').proxyval(visited)
-        return ProxyException(self.safe_tp_name(),
-                              arg_proxy)
+        if walk.seen(self):
+            yield ProxyAlreadyVisited('(...)')
+            return
+        arg_proxy = yield self.pyop_field('args')
+        yield ProxyException(self.safe_tp_name(),
+                             arg_proxy)
 
-    def write_repr(self, out, visited):
+    def _repr_steps(self, walk):
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            out.write('(...)')
+        if walk.seen(self):
+            yield '(...)'
             return
-        visited.add(self.as_address())
 
-        out.write(self.safe_tp_name())
-        self.write_field_repr('args', out, visited)
+        yield self.safe_tp_name()
+        yield self.pyop_field('args')
 
 
 class PyBoolObjectPtr(PyObjectPtr):
@@ -571,10 +1332,11 @@ class PyBoolObjectPtr(PyObjectPtr):
     Class wrapping a gdb.Value that's a PyBoolObject* i.e. one of the two
     <bool> instances (Py_True/Py_False) within the process being debugged.
     """
+    __slots__ = ()
     _typename = 'PyBoolObject'
 
     def proxyval(self, visited):
-        if int_from_int(self.field('ob_ival')):
+        if self.read_field('ob_ival'):
             return True
         else:
             return False
@@ -585,10 +1347,13 @@ class PyClassObjectPtr(PyObjectPtr):
     Class wrapping a gdb.Value that's a PyClassObject* i.e. a <classobj>
     instance within the process being debugged.
     """
+    __slots__ = ()
     _typename = 'PyClassObject'
 
 
 class BuiltInFunctionProxy(object):
+    __slots__ = ('ml_name',)
+
     def __init__(self, ml_name):
         self.ml_name = ml_name
 
@@ -597,6 +1362,8 @@ class BuiltInFunctionProxy(object):
 
 
 class BuiltInMethodProxy(object):
+    __slots__ = ('ml_name', 'pyop_m_self')
+
     def __init__(self, ml_name, pyop_m_self):
         self.ml_name = ml_name
         self.pyop_m_self = pyop_m_self
@@ -614,11 +1381,13 @@ class PyCFunctionObjectPtr(PyObjectPtr):
     Class wrapping a gdb.Value that's a PyCFunctionObject*
     (see Include/methodobject.h and Objects/methodobject.c)
     """
+    __slots__ = ()
     _typename = 'PyCFunctionObject'
 
     def proxyval(self, visited):
-        m_ml = self.field('m_ml')  # m_ml is a (PyMethodDef*)
-        ml_name = m_ml['ml_name'].string()
+        m_ml = self.read_field('m_ml')  # m_ml is a (PyMethodDef*)
+        ml_name = read_string(get_layout('PyMethodDef').read_field(
+            m_ml, 'ml_name'))
 
         pyop_m_self = self.pyop_field('m_self')
         if pyop_m_self.is_null():
@@ -632,28 +1401,245 @@ class PyCodeObjectPtr(PyObjectPtr):
     Class wrapping a gdb.Value that's a PyCodeObject* i.e. a <code> instance
     within the process being debugged.
     """
+    __slots__ = ()
     _typename = 'PyCodeObject'
 
+    def addr2line(self, addrq):
+        """
+        Get the line number for a given bytecode offset
+
+        Analogous to PyCode_Addr2Line; see PyCodeInfo.addr2line
+        """
+        return self.code_info().addr2line(addrq)
+
+    def code_info(self):
+        """Get the cached PyCodeInfo for this code object"""
+        return get_code_info(self.as_address())
+
+
+class PyCodeInfo(object):
+    """
+    The data of a (PyCodeObject*) needed to resolve names in its frames:
+    the addresses of the local variable names (co_varnames) and name
+    lookup tables for them and for the global names used (co_names), and
+    the decoded line number table (co_lnotab).
+
+    Cached per code address by get_code_info, with each part read from
+    the inferior on first use only, so that e.g. stepping, which only
+    needs the line table, never decodes the names. Code objects are
+    immutable, so the data only needs checking against a fingerprint of
+    the code object after the inferior has run, in case it was deallocated
+    and the memory reused.
+    """
+
+    _key_fields = ('co_code', 'co_varnames', 'co_names', 'co_lnotab',
+                   'co_nlocals', 'co_firstlineno')
+
+    def __init__(self, address):
+        code = PyCodeObjectPtr(address=address)
+        self.address = address
+        self.epoch = memory_cache.epoch
+        self._key = self._read_key(code)
+        self.co_nlocals = code.read_field('co_nlocals')
+
+        # Read on first use, see varnames, local_index, name_key and
+        # line_table
+        self._varnames = None
+        self._varname_index = None
+        self._name_address = None
+        self._line_table = None
+
+    @classmethod
+    def _read_key(cls, code):
+        return tuple([code.read_field(name) for name in cls._key_fields])
+
+    def is_valid(self):
+        """
+        Check that the code object is still the one this info was resolved
+        from, if the inferior has run since
+        """
+        if self.epoch != memory_cache.epoch:
+            code = PyCodeObjectPtr(address=self.address)
+            if self._read_key(code) != self._key:
+                return False
+            self.epoch = memory_cache.epoch
+        return True
+
+    def varnames(self):
+        """
+        Get the addresses of the names of the locals, in the order of
+        f_localsplus
+        """
+        if self._varnames is None:
+            code = PyCodeObjectPtr(address=self.address)
+            nlocals = safety_limit(self.co_nlocals)
+            self._varnames = code.pyop_field('co_varnames')[0:nlocals]
+        return self._varnames
+
+    def local_index(self, name):
+        """
+        Get the index in f_localsplus of local variable *name*, or None if
+        the code has no such local
+        """
+        if self._varname_index is None:
+            varname_index = {}
+            for index, address in enumerate(self.varnames()):
+                varname_index.setdefault(
+                    PyObjectPtr.from_address(address).proxyval(set()), index)
+            self._varname_index = varname_index
+        return self._varname_index.get(name)
+
+    def line_table(self):
+        """
+        Get the line table decoded from co_lnotab, as a pair of lists: the
+        bytecode offsets where the line changes, and the line numbers
+        before each of them plus the last line number
+        """
+        if self._line_table is None:
+            code = PyCodeObjectPtr(address=self.address)
+            co_lnotab = bytearray(code.pyop_field('co_lnotab').proxyval(set()))
+
+            # Initialize lineno to co_firstlineno as per PyCode_Addr2Line
+            # not 0, as lnotab_notes.txt has it:
+            lineno = code.read_field('co_firstlineno')
+
+            addr = 0
+            addrs = []
+            lines = [lineno]
+            for addr_incr, line_incr in zip(co_lnotab[::2], co_lnotab[1::2]):
+                addr += addr_incr
+                lineno += line_incr
+                addrs.append(addr)
+                lines.append(lineno)
+            self._line_table = (addrs, lines)
+        return self._line_table
+
     def addr2line(self, addrq):
         """
         Get the line number for a given bytecode offset
 
         Analogous to PyCode_Addr2Line; translated from pseudocode in
-        Objects/lnotab_notes.txt
+        Objects/lnotab_notes.txt: the line is the one in effect after the
+        last address increment not beyond addrq
+        """
+        (addrs, lines) = self.line_table()
+        return lines[bisect.bisect_right(addrs, addrq)]
+
+    def name_key(self, name):
+        """
+        Get the key to look up global or builtin *name* with: the interned
+        name object if the code uses that name, so that dict entries match
+        by address without decoding their keys, or else *name* itself
         """
-        co_lnotab = self.pyop_field('co_lnotab').proxyval(set())
+        if self._name_address is None:
+            # The (interned) name objects of the globals and builtins used
+            name_address = {}
+            code = PyCodeObjectPtr(address=self.address)
+            names = code.pyop_field('co_names')
+            for address in names[0:names.read_field('ob_size')]:
+                name_address.setdefault(
+                    PyObjectPtr.from_address(address).proxyval(set()),
+                    address)
+            self._name_address = name_address
+        address = self._name_address.get(name)
+        if address is None:
+            return name
+        return PyObjectPtr.from_address(address)
+
+
+_code_cache = {}
+
+
+def get_code_info(address):
+    """
+    Get the PyCodeInfo for the (PyCodeObject*) at *address*, cached so
+    that its data is read from the inferior only once per code object
+    """
+    code_info = _code_cache.get(address)
+    if code_info is None or not code_info.is_valid():
+        if address == 0:
+            raise NullPyObjectPtr(address)
+        code_info = _code_cache[address] = PyCodeInfo(address)
+    return code_info
 
-        # Initialize lineno to co_firstlineno as per PyCode_Addr2Line
-        # not 0, as lnotab_notes.txt has it:
-        lineno = int_from_int(self.field('co_firstlineno'))
 
-        addr = 0
-        for addr_incr, line_incr in zip(co_lnotab[::2], co_lnotab[1::2]):
-            addr += ord(addr_incr)
-            if addr > addrq:
-                return lineno
-            lineno += ord(line_incr)
-        return lineno
+_hash_secret = None
+
+
+def get_hash_secret():
+    """
+    Get the (prefix, suffix) of _Py_HashSecret in the inferior process, which
+    is (0, 0) unless hash randomization is enabled (or before python 2.7.3,
+    which doesn't have it)
+    """
+    global _hash_secret
+    if _hash_secret is None:
+        try:
+            secret = gdb.parse_and_eval('_Py_HashSecret')
+            _hash_secret = (long(secret['prefix']), long(secret['suffix']))
+        except RuntimeError:
+            _hash_secret = (0, 0)
+    return _hash_secret
+
+
+def _sequence_hash(units):
+    """
+    Transliteration of string_hash and unicode_hash of python 2.7 for the
+    given bytes or unicode code units, as an unsigned machine word
+    """
+    if not units:
+        return 0
+    word_mask = (1 << (8 * SIZEOF_VOID_P)) - 1
+    (prefix, suffix) = get_hash_secret()
+    x = (prefix ^ (units[0] << 7)) & word_mask
+    for unit in units:
+        x = ((1000003 * x) ^ unit) & word_mask
+    x ^= len(units)
+    x = (x ^ suffix) & word_mask
+    if x == word_mask:
+        # -1 is reserved for errors
+        x = word_mask - 1
+    return x
+
+
+def local_hash(key):
+    """
+    Compute the hash the inferior process has for python value *key*, as an
+    unsigned machine word, or None for types this isn't implemented for
+    """
+    word_bits = 8 * SIZEOF_VOID_P
+    if isinstance(key, str):
+        return _sequence_hash(bytearray(key))
+    if isinstance(key, unicode):
+        if get_unicode_width() == 2:
+            encoding, fmt = 'utf-16-le', 'H'
+        else:
+            encoding, fmt = 'utf-32-le', 'I'
+        data = key.encode(encoding)
+        return _sequence_hash(array.array(fmt, data) if data else [])
+    if isinstance(key, (int, long)) \
+            and -(1 << (word_bits - 1)) <= key < (1 << (word_bits - 1)):
+        # Integers that fit a C long hash to themselves, for ints and longs
+        if key == -1:
+            key = -2
+        return key & ((1 << word_bits) - 1)
+    return None
+
+
+def _key_matches(pyop_key, key):
+    """Tell if the inferior object pyop_key equals python value key"""
+    if isinstance(pyop_key, PyStringObjectPtr):
+        # Compare the sizes before reading the string itself
+        if isinstance(key, str):
+            return (pyop_key.read_field('ob_size') == len(key)
+                    and str(pyop_key) == key)
+    elif pyop_key._proxyval_steps is not None:
+        # Don't materialise containers (tuple keys) for the comparison
+        return False
+    try:
+        return pyop_key.proxyval(set()) == key
+    except RuntimeError:
+        return False
 
 
 class PyDictObjectPtr(PyObjectPtr):
@@ -661,134 +1647,280 @@ class PyDictObjectPtr(PyObjectPtr):
     Class wrapping a gdb.Value that's a PyDictObject* i.e. a dict instance
     within the process being debugged.
     """
+    __slots__ = ()
     _typename = 'PyDictObject'
 
+    def iter_entries(self):
+        """
+        Yields a sequence of (key address, value address) pairs for the live
+        entries of the hash table, which is fetched with a single read
+        """
+        entry_layout = get_layout('PyDictEntry')
+        # PyDictEntry is a (me_hash, me_key, me_value) triple of words, so
+        # the table is read as one pointer vector and sliced per field
+        stride = entry_layout.sizeof // SIZEOF_VOID_P
+        key_index = entry_layout.offset('me_key') // SIZEOF_VOID_P
+        value_index = entry_layout.offset('me_value') // SIZEOF_VOID_P
+        slots = max(0, min(self.read_field('ma_mask') + 1,
+                           MAX_READ_SIZE // entry_layout.sizeof))
+        table = read_pointers(self.read_field('ma_table'), slots * stride)
+        keys = table[key_index::stride]
+        values = table[value_index::stride]
+        # Empty and deleted (dummy) slots have a NULL me_value:
+        return itertools.compress(itertools.izip(keys, values), values)
+
     def iteritems(self):
         """
         Yields a sequence of (PyObjectPtr key, PyObjectPtr value) pairs,
         analagous to dict.iteritems()
         """
-        for i in safe_range(self.field('ma_mask') + 1):
-            ep = self.field('ma_table') + i
-            pyop_value = PyObjectPtr.from_pyobject_ptr(ep['me_value'])
-            if not pyop_value.is_null():
-                pyop_key = PyObjectPtr.from_pyobject_ptr(ep['me_key'])
-                yield (pyop_key, pyop_value)
+        for key, value in self.iter_entries():
+            yield (PyObjectPtr.from_address(key),
+                   PyObjectPtr.from_address(value))
 
-    def proxyval(self, visited):
+    def get_item(self, key):
+        """
+        Get the PyObjectPtr for the value of *key*, or None if it's not
+        found. *key* is either a python value of a simple type (str,
+        unicode, int, ...) or a PyObjectPtr for such a key in the inferior.
+
+        For keys that local_hash supports the lookup follows the probe
+        sequence of the inferior's hash table, like lookdict does, so only
+        a few entries are read. Keys are compared by address first, and by
+        content only when the hashes match.
+        """
+        key_address = None
+        if isinstance(key, PyObjectPtr):
+            key_address = key.as_address()
+            key = key.proxyval(set())
+        hash = local_hash(key)
+        if hash is None:
+            return self._scan_item(key)
+        return self._probe_item(key, key_address, hash)
+
+    def _scan_item(self, key):
+        # Compare the keys of all the entries, stopping at the first match
+        for key_address, value in self.iter_entries():
+            if _key_matches(PyObjectPtr.from_address(key_address), key):
+                return PyObjectPtr.from_address(value)
+        return None
+
+    def _probe_item(self, key, key_address, hash):
+        # Transliteration of lookdict in Objects/dictobject.c
+        entry_layout = get_layout('PyDictEntry')
+        entry_words = entry_layout.sizeof // SIZEOF_VOID_P
+        hash_index = entry_layout.offset('me_hash') // SIZEOF_VOID_P
+        key_index = entry_layout.offset('me_key') // SIZEOF_VOID_P
+        value_index = entry_layout.offset('me_value') // SIZEOF_VOID_P
+        word_mask = (1 << (8 * SIZEOF_VOID_P)) - 1
+        PERTURB_SHIFT = 5
+
+        mask = self.read_field('ma_mask')
+        table = self.read_field('ma_table')
+        i = hash & mask
+        perturb = hash
+        # The table always has free slots, so this bound is only hit when
+        # the data is corrupt
+        for _ in xrange(mask + 1):
+            entry = read_pointers(table + (i & mask) * entry_layout.sizeof,
+                                  entry_words)
+            me_key = entry[key_index]
+            if me_key == 0:
+                return None
+            me_value = entry[value_index]
+            # Deleted (dummy) entries have a NULL me_value
+            if me_value != 0:
+                if me_key == key_address:
+                    return PyObjectPtr.from_address(me_value)
+                if entry[hash_index] == hash and _key_matches(
+                        PyObjectPtr.from_address(me_key), key):
+                    return PyObjectPtr.from_address(me_value)
+            i = ((i << 2) + i + perturb + 1) & word_mask
+            perturb >>= PERTURB_SHIFT
+        return None
+
+    def lazyval(self):
+        return LazyDictProxy(self)
+
+    def _proxyval_steps(self, walk):
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            return ProxyAlreadyVisited('{...}')
-        visited.add(self.as_address())
+        if walk.seen(self):
+            yield ProxyAlreadyVisited('{...}')
+            return
 
         result = {}
-        for pyop_key, pyop_value in self.iteritems():
-            proxy_key = pyop_key.proxyval(visited)
-            proxy_value = pyop_value.proxyval(visited)
+        for i, (pyop_key, pyop_value) in enumerate(self.iteritems()):
+            if walk.too_many(i):
+                break
+            proxy_key = yield pyop_key
+            proxy_value = yield pyop_value
             result[proxy_key] = proxy_value
-        return result
+        yield result
 
-    def write_repr(self, out, visited):
+    def _repr_steps(self, walk):
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            out.write('{...}')
+        if walk.seen(self):
+            yield '{...}'
             return
-        visited.add(self.as_address())
 
-        out.write('{')
-        first = True
-        for pyop_key, pyop_value in self.iteritems():
-            if not first:
-                out.write(', ')
-            first = False
-            pyop_key.write_repr(out, visited)
-            out.write(': ')
-            pyop_value.write_repr(out, visited)
-        out.write('}')
+        yield '{'
+        for i, (pyop_key, pyop_value) in enumerate(self.iteritems()):
+            if i > 0:
+                yield ', '
+            if walk.too_many(i):
+                yield '...'
+                break
+            yield pyop_key
+            yield ': '
+            yield pyop_value
+        yield '}'
 
 
 class PyInstanceObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PyInstanceObject'
 
-    def proxyval(self, visited):
+    def get_attr(self, name):
+        """
+        Get the PyObjectPtr for attribute *name* from in_dict, or None if
+        there's no such attribute
+        """
+        pyop_in_dict = self.pyop_field('in_dict')
+        if isinstance(pyop_in_dict, PyDictObjectPtr):
+            return pyop_in_dict.get_item(name)
+        return None
+
+    def lazyval(self):
+        return LazyInstanceProxy(self)
+
+    def _proxyval_steps(self, walk):
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            return ProxyAlreadyVisited('<...>')
-        visited.add(self.as_address())
+        if walk.seen(self):
+            yield ProxyAlreadyVisited('<...>')
+            return
 
         # Get name of class:
         in_class = self.pyop_field('in_class')
-        cl_name = in_class.pyop_field('cl_name').proxyval(visited)
+        cl_name = in_class.pyop_field('cl_name').proxyval(walk.visited)
 
         # Get dictionary of instance attributes:
-        in_dict = self.pyop_field('in_dict').proxyval(visited)
+        in_dict = yield self.pyop_field('in_dict')
 
         # Old-style class:
-        return InstanceProxy(cl_name, in_dict, long(self._gdbval))
+        yield InstanceProxy(cl_name, in_dict, self.as_address())
 
-    def write_repr(self, out, visited):
+    def _repr_steps(self, walk):
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            out.write('<...>')
+        if walk.seen(self):
+            yield '<...>'
             return
-        visited.add(self.as_address())
 
         # Old-style class:
 
         # Get name of class:
         in_class = self.pyop_field('in_class')
-        cl_name = in_class.pyop_field('cl_name').proxyval(visited)
+        cl_name = in_class.pyop_field('cl_name').proxyval(walk.visited)
 
         # Get dictionary of instance attributes:
         pyop_in_dict = self.pyop_field('in_dict')
 
-        _write_instance_repr(out, visited,
-                             cl_name, pyop_in_dict, self.as_address())
+        for step in _instance_repr_steps(walk, cl_name, pyop_in_dict,
+                                         self.as_address()):
+            yield step
 
 
 class PyIntObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PyIntObject'
 
     def proxyval(self, visited):
-        result = int_from_int(self.field('ob_ival'))
+        result = self.read_field('ob_ival')
         return result
 
 
+def read_items(ob_item, size, index):
+    """
+    Read the (PyObject*) addresses of a list or tuple item vector starting
+    at *ob_item* and holding *size* items. *index* is either an int, giving
+    one address, or a slice, giving an array of addresses fetched with a
+    single read
+    """
+    if isinstance(index, slice):
+        indices = xrange(*index.indices(size))
+        if not indices:
+            return read_pointers(ob_item, 0)
+        low = min(indices[0], indices[-1])
+        high = min(max(indices[0], indices[-1]) + 1,
+                   low + MAX_READ_SIZE // SIZEOF_VOID_P)
+        vector = read_pointers(ob_item + low * SIZEOF_VOID_P, high - low)
+        return vector[indices[0] - low::index.step or 1]
+    if index < 0:
+        index += size
+    if not 0 <= index < size:
+        raise IndexError('index out of range')
+    return read_pointers(ob_item + index * SIZEOF_VOID_P, 1)[0]
+
+
+def iter_items(ob_item, size):
+    """
+    Yields the PyObjectPtr for each item of a list or tuple item vector,
+    with the pointers read in one go, bounded by MAX_READ_SIZE like the
+    hash tables of dicts and sets
+    """
+    size = max(0, min(size, MAX_READ_SIZE // SIZEOF_VOID_P))
+    addresses = read_items(ob_item, size, slice(0, size))
+    return PyObjectPtr.from_addresses(addresses)
+
+
 class PyListObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PyListObject'
 
     def __getitem__(self, i):
-        # Get the gdb.Value for the (PyObject*) with the given index:
-        field_ob_item = self.field('ob_item')
-        return field_ob_item[i]
+        # Get the address of the (PyObject*) with the given index, or an
+        # array of addresses for a slice:
+        return read_items(self.read_field('ob_item'),
+                          self.read_field('ob_size'), i)
 
-    def proxyval(self, visited):
+    def iter_items(self):
+        return iter_items(self.read_field('ob_item'),
+                          self.read_field('ob_size'))
+
+    def lazyval(self):
+        return LazySequenceProxy(self)
+
+    def _proxyval_steps(self, walk):
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            return ProxyAlreadyVisited('[...]')
-        visited.add(self.as_address())
+        if walk.seen(self):
+            yield ProxyAlreadyVisited('[...]')
+            return
 
-        result = [PyObjectPtr.from_pyobject_ptr(self[i]).proxyval(visited)
-                  for i in safe_range(int_from_int(self.field('ob_size')))]
-        return result
+        result = []
+        for i, element in enumerate(self.iter_items()):
+            if walk.too_many(i):
+                break
+            result.append((yield element))
+        yield result
 
-    def write_repr(self, out, visited):
+    def _repr_steps(self, walk):
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            out.write('[...]')
+        if walk.seen(self):
+            yield '[...]'
             return
-        visited.add(self.as_address())
 
-        out.write('[')
-        for i in safe_range(int_from_int(self.field('ob_size'))):
+        yield '['
+        for i, element in enumerate(self.iter_items()):
             if i > 0:
-                out.write(', ')
-            element = PyObjectPtr.from_pyobject_ptr(self[i])
-            element.write_repr(out, visited)
-        out.write(']')
+                yield ', '
+            if walk.too_many(i):
+                yield '...'
+                break
+            yield element
+        yield ']'
 
 
 class PyLongObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PyLongObject'
 
     def proxyval(self, visited):
@@ -809,20 +1941,23 @@ class PyLongObjectPtr(PyObjectPtr):
             #define PyLong_SHIFT        30
             #define PyLong_SHIFT        15
         """
-        ob_size = long(self.field('ob_size'))
+        ob_size = self.read_field('ob_size')
         if ob_size == 0:
             return 0L
 
-        ob_digit = self.field('ob_digit')
-
-        if gdb.lookup_type('digit').sizeof == 2:
-            SHIFT = 15L
+        if get_digit_size() == 2:
+            SHIFT = 15
         else:
-            SHIFT = 30L
-
-        digits = [long(ob_digit[i]) * 2**(SHIFT*i)
-                  for i in safe_range(abs(ob_size))]
-        result = sum(digits)
+            SHIFT = 30
+
+        # Read all the digits at once, bounded by MAX_READ_SIZE like the
+        # other variable sized objects, and combine them starting from the
+        # most significant one
+        digits = self.read_array_field(
+            'ob_digit', min(abs(ob_size), MAX_READ_SIZE // get_digit_size()))
+        result = 0L
+        for digit in reversed(digits):
+            result = (result << SHIFT) | digit
         if ob_size < 0:
             result = -result
         return result
@@ -833,6 +1968,7 @@ class PyNoneStructPtr(PyObjectPtr):
     Class wrapping a gdb.Value that's a PyObject* pointing to the
     singleton (we hope) _Py_NoneStruct with ob_type PyNone_Type
     """
+    __slots__ = ()
     _typename = 'PyObject'
 
     def proxyval(self, visited):
@@ -840,21 +1976,57 @@ class PyNoneStructPtr(PyObjectPtr):
 
 
 class PyFrameObjectPtr(PyObjectPtr):
+    """
+    Class wrapping a PyFrameObject*. The attributes of the frame and its
+    code object are only read from the inferior when first used.
+    """
+    __slots__ = ('_co', '_co_name', '_co_filename')
     _typename = 'PyFrameObject'
 
-    def __init__(self, gdbval, cast_to):
-        PyObjectPtr.__init__(self, gdbval, cast_to)
-
-        if not self.is_optimized_out():
-            self.co = PyCodeObjectPtr.from_pyobject_ptr(self.field('f_code'))
-            self.co_name = self.co.pyop_field('co_name')
-            self.co_filename = self.co.pyop_field('co_filename')
-            self.f_lineno = int_from_int(self.field('f_lineno'))
-            self.f_lasti = int_from_int(self.field('f_lasti'))
-            self.co_nlocals = int_from_int(self.co.field('co_nlocals'))
-            self.co_varnames = PyTupleObjectPtr.from_pyobject_ptr(
-                self.co.field('co_varnames'))
-            self.f_back = self.field('f_back')
+    def __init__(self, gdbval=None, cast_to=None, address=None,
+                 type_info=None):
+        PyObjectPtr.__init__(self, gdbval, cast_to, address, type_info)
+        self._co = None
+        self._co_name = None
+        self._co_filename = None
+
+    @property
+    def co(self):
+        if self._co is None:
+            self._co = PyCodeObjectPtr.from_address(self.read_field('f_code'))
+        return self._co
+
+    @property
+    def co_name(self):
+        if self._co_name is None:
+            self._co_name = self.co.pyop_field('co_name')
+        return self._co_name
+
+    @property
+    def co_filename(self):
+        if self._co_filename is None:
+            self._co_filename = self.co.pyop_field('co_filename')
+        return self._co_filename
+
+    @property
+    def co_nlocals(self):
+        return self.co.code_info().co_nlocals
+
+    @property
+    def co_varnames(self):
+        return self.co.pyop_field('co_varnames')
+
+    @property
+    def f_lineno(self):
+        return self.read_field('f_lineno')
+
+    @property
+    def f_lasti(self):
+        return self.read_field('f_lasti')
+
+    @property
+    def f_back(self):
+        return self.read_field('f_back')
 
     def iter_locals(self):
         """
@@ -864,11 +2036,12 @@ class PyFrameObjectPtr(PyObjectPtr):
         if self.is_optimized_out():
             return
 
-        f_localsplus = self.field('f_localsplus')
-        for i in safe_range(self.co_nlocals):
-            pyop_value = PyObjectPtr.from_pyobject_ptr(f_localsplus[i])
-            if not pyop_value.is_null():
-                pyop_name = PyObjectPtr.from_pyobject_ptr(self.co_varnames[i])
+        varnames = self.co.code_info().varnames()
+        f_localsplus = self.read_array_field('f_localsplus', len(varnames))
+        for value, name in zip(f_localsplus, varnames):
+            if value != 0:
+                pyop_value = PyObjectPtr.from_address(value)
+                pyop_name = PyObjectPtr.from_address(name)
                 yield (pyop_name, pyop_value)
 
     def iter_globals(self):
@@ -899,16 +2072,28 @@ class PyFrameObjectPtr(PyObjectPtr):
         where scope is a string 'local', 'global', 'builtin'
 
         If not found, return (None, None)
+
+        Locals are found through the cached index of co_varnames, globals
+        and builtins by probing the dicts (see PyDictObjectPtr.get_item)
         """
-        for pyop_name, pyop_value in self.iter_locals():
-            if name == pyop_name.proxyval(set()):
-                return pyop_value, 'local'
-        for pyop_name, pyop_value in self.iter_globals():
-            if name == pyop_name.proxyval(set()):
-                return pyop_value, 'global'
-        for pyop_name, pyop_value in self.iter_builtins():
-            if name == pyop_name.proxyval(set()):
-                return pyop_value, 'builtin'
+        if self.is_optimized_out():
+            return None, None
+
+        code_info = self.co.code_info()
+        index = code_info.local_index(name)
+        if index is not None:
+            value = self.read_array_field('f_localsplus', index + 1)[index]
+            if value != 0:
+                return PyObjectPtr.from_address(value), 'local'
+
+        key = code_info.name_key(name)
+        for field, scope in (('f_globals', 'global'),
+                             ('f_builtins', 'builtin')):
+            pyop_dict = self.pyop_field(field)
+            if isinstance(pyop_dict, PyDictObjectPtr):
+                pyop_value = pyop_dict.get_item(key)
+                if pyop_value is not None:
+                    return pyop_value, scope
         return None, None
 
     def filename(self):
@@ -926,8 +2111,8 @@ class PyFrameObjectPtr(PyObjectPtr):
         """
         if self.is_optimized_out():
             return None
-        f_trace = self.field('f_trace')
-        if long(f_trace) != 0:
+        f_trace = self.read_field('f_trace')
+        if f_trace != 0:
             # we have a non-NULL f_trace:
             return self.f_lineno
         else:
@@ -946,166 +2131,407 @@ class PyFrameObjectPtr(PyObjectPtr):
             # Convert from 1-based current_line_num to 0-based list offset:
             return all_lines[self.current_line_num()-1]
 
-    def write_repr(self, out, visited):
+    def _repr_steps(self, walk):
         if self.is_optimized_out():
-            out.write('(frame information optimized out)')
+            yield '(frame information optimized out)'
             return
-        out.write('Frame 0x%x, for file %s, line %i, in %s ('
-                  % (self.as_address(),
-                     self.co_filename,
-                     self.current_line_num(),
-                     self.co_name))
-        first = True
-        for pyop_name, pyop_value in self.iter_locals():
-            if not first:
-                out.write(', ')
-            first = False
+        yield ('Frame 0x%x, for file %s, line %i, in %s ('
+               % (self.as_address(),
+                  self.co_filename,
+                  self.current_line_num(),
+                  self.co_name))
+        for i, (pyop_name, pyop_value) in enumerate(self.iter_locals()):
+            if i > 0:
+                yield ', '
+            if walk.too_many(i):
+                yield '...'
+                break
+
+            yield pyop_name.proxyval(walk.visited)
+            yield '='
+            yield pyop_value
 
-            out.write(pyop_name.proxyval(visited))
-            out.write('=')
-            pyop_value.write_repr(out, visited)
+        yield ')'
 
-        out.write(')')
+
+_set_dummy = None
+
+
+def get_set_dummy():
+    """
+    Get the address of the "<dummy key>" object that marks deleted set
+    entries (the static "dummy" of Objects/setobject.c), or 0 if gdb can't
+    resolve it
+    """
+    global _set_dummy
+    if _set_dummy is None:
+        try:
+            _set_dummy = long(gdb.parse_and_eval("'setobject.c'::dummy"))
+        except RuntimeError:
+            _set_dummy = 0
+    return _set_dummy
+
+
+def _is_set_dummy(key):
+    """
+    Tell if *key* is the set dummy by its contents, for when its address
+    couldn't be resolved; once found the address is remembered
+    """
+    global _set_dummy
+    pyop_key = PyObjectPtr.from_address(key)
+    if isinstance(pyop_key, PyStringObjectPtr) \
+            and pyop_key.read_field('ob_size') == len('<dummy key>') \
+            and str(pyop_key) == '<dummy key>':
+        _set_dummy = key
+        return True
+    return False
 
 
 class PySetObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PySetObject'
 
-    def proxyval(self, visited):
+    def iter_keys(self):
+        """
+        Yields the addresses of the keys of the hash table, which is
+        fetched with a single read. Empty and deleted (dummy) entries are
+        skipped by comparing pointers, without decoding any keys.
+        """
+        entry_layout = get_layout('setentry')
+        # setentry is a (hash, key) pair of words, so the table is read as
+        # one pointer vector and sliced
+        stride = entry_layout.sizeof // SIZEOF_VOID_P
+        key_index = entry_layout.offset('key') // SIZEOF_VOID_P
+        slots = max(0, min(self.read_field('mask') + 1,
+                           MAX_READ_SIZE // entry_layout.sizeof))
+        table = read_pointers(self.read_field('table'), slots * stride)
+        keys = itertools.ifilter(None, table[key_index::stride])
+        dummy = get_set_dummy()
+        if dummy:
+            return (key for key in keys if key != dummy)
+        return itertools.ifilterfalse(_is_set_dummy, keys)
+
+    def _proxyval_steps(self, walk):
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            return ProxyAlreadyVisited('%s(...)' % self.safe_tp_name())
-        visited.add(self.as_address())
+        if walk.seen(self):
+            yield ProxyAlreadyVisited('%s(...)' % self.safe_tp_name())
+            return
 
         members = []
-        table = self.field('table')
-        for i in safe_range(self.field('mask')+1):
-            setentry = table[i]
-            key = setentry['key']
-            if key != 0:
-                key_proxy = PyObjectPtr.from_pyobject_ptr(
-                    key).proxyval(visited)
-                if key_proxy != '<dummy key>':
-                    members.append(key_proxy)
+        keys = PyObjectPtr.from_addresses(self.iter_keys())
+        for i, pyop_key in enumerate(keys):
+            if walk.too_many(i):
+                break
+            members.append((yield pyop_key))
         if self.safe_tp_name() == 'frozenset':
-            return frozenset(members)
+            yield frozenset(members)
         else:
-            return set(members)
+            yield set(members)
 
-    def write_repr(self, out, visited):
-        out.write(self.safe_tp_name())
+    def _repr_steps(self, walk):
+        yield self.safe_tp_name()
 
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            out.write('(...)')
+        if walk.seen(self):
+            yield '(...)'
             return
-        visited.add(self.as_address())
-
-        out.write('([')
-        first = True
-        table = self.field('table')
-        for i in safe_range(self.field('mask')+1):
-            setentry = table[i]
-            key = setentry['key']
-            if key != 0:
-                pyop_key = PyObjectPtr.from_pyobject_ptr(key)
-                key_proxy = pyop_key.proxyval(visited)  # FIXME!
-                if key_proxy != '<dummy key>':
-                    if not first:
-                        out.write(', ')
-                    first = False
-                    pyop_key.write_repr(out, visited)
-        out.write('])')
+
+        yield '(['
+        keys = PyObjectPtr.from_addresses(self.iter_keys())
+        for i, pyop_key in enumerate(keys):
+            if i > 0:
+                yield ', '
+            if walk.too_many(i):
+                yield '...'
+                break
+            yield pyop_key
+        yield '])'
 
 
 class PyStringObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PyStringObject'
 
+    def read_bytes(self, maxlen=None):
+        """
+        Read the string data with a single memory read; if *maxlen* is given
+        only that many leading bytes are read
+        """
+        ob_size = max(0, min(self.read_field('ob_size'), MAX_READ_SIZE))
+        if maxlen is not None:
+            ob_size = min(ob_size, maxlen)
+        offset = self.get_layout().offset('ob_sval')
+        return read_memory(self.as_address() + offset, ob_size)
+
     def __str__(self):
-        field_ob_size = self.field('ob_size')
-        field_ob_sval = self.field('ob_sval')
-        char_ptr = field_ob_sval.address.cast(_type_unsigned_char_ptr)
-        return ''.join([chr(char_ptr[i]) for i in safe_range(field_ob_size)])
+        return self.read_bytes()
 
     def proxyval(self, visited):
         return str(self)
 
+    def write_repr(self, out, visited):
+        # The repr of a string is at least as long as the string itself, so
+        # reading what still fits in "out" is enough to fill it. (Only the
+        # choice of quote character can differ from the repr of the whole
+        # string.) Other file-like objects get the whole string.
+        remaining = getattr(out, 'remaining', None)
+        if remaining is not None:
+            remaining = remaining()
+        out.write(repr(self.read_bytes(remaining)))
+
 
 class PyTupleObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PyTupleObject'
 
+    def ob_item(self):
+        # The item vector is inline, at the end of the struct
+        return self.as_address() + self.get_layout().offset('ob_item')
+
     def __getitem__(self, i):
-        # Get the gdb.Value for the (PyObject*) with the given index:
-        field_ob_item = self.field('ob_item')
-        return field_ob_item[i]
+        # Get the address of the (PyObject*) with the given index, or an
+        # array of addresses for a slice:
+        return read_items(self.ob_item(), self.read_field('ob_size'), i)
 
-    def proxyval(self, visited):
+    def iter_items(self):
+        return iter_items(self.ob_item(), self.read_field('ob_size'))
+
+    def lazyval(self):
+        return LazySequenceProxy(self)
+
+    def _proxyval_steps(self, walk):
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            return ProxyAlreadyVisited('(...)')
-        visited.add(self.as_address())
+        if walk.seen(self):
+            yield ProxyAlreadyVisited('(...)')
+            return
 
-        result = tuple([PyObjectPtr.from_pyobject_ptr(
-            self[i]).proxyval(visited)
-            for i in safe_range(int_from_int(self.field('ob_size')))])
-        return result
+        result = []
+        for i, element in enumerate(self.iter_items()):
+            if walk.too_many(i):
+                break
+            result.append((yield element))
+        yield tuple(result)
 
-    def write_repr(self, out, visited):
+    def _repr_steps(self, walk):
         # Guard against infinite loops:
-        if self.as_address() in visited:
-            out.write('(...)')
+        if walk.seen(self):
+            yield '(...)'
             return
-        visited.add(self.as_address())
 
-        out.write('(')
-        for i in safe_range(int_from_int(self.field('ob_size'))):
+        yield '('
+        for i, element in enumerate(self.iter_items()):
             if i > 0:
-                out.write(', ')
-            element = PyObjectPtr.from_pyobject_ptr(self[i])
-            element.write_repr(out, visited)
-        if self.field('ob_size') == 1:
-            out.write(',)')
+                yield ', '
+            if walk.too_many(i):
+                yield '...'
+                break
+            yield element
+        if self.read_field('ob_size') == 1 and not walk.too_many(0):
+            yield ',)'
         else:
-            out.write(')')
+            yield ')'
 
 
 class PyTypeObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PyTypeObject'
 
+    def tp_name(self):
+        return read_string(self.read_field('tp_name'))
+
+
+_tp_name_map = {'bool': PyBoolObjectPtr,
+                'classobj': PyClassObjectPtr,
+                'instance': PyInstanceObjectPtr,
+                'NoneType': PyNoneStructPtr,
+                'frame': PyFrameObjectPtr,
+                'set': PySetObjectPtr,
+                'frozenset': PySetObjectPtr,
+                'builtin_function_or_method': PyCFunctionObjectPtr,
+                }
+
+
+class PyTypeInfo(object):
+    """
+    The data of a (PyTypeObject*) that the wrappers need for every object of
+    that type: the PyObjectPtr subclass to use, tp_name, tp_flags and the
+    sizes used to locate instance dictionaries.
+
+    Resolved once per type address by get_type_info, so that containers
+    of many objects of the same type only pay the cost of reading the type
+    once.
+    """
+
+    def __init__(self, address):
+        typeobj = PyTypeObjectPtr(address=address)
+        self.address = address
+        self.epoch = memory_cache.epoch
+        self.tp_name = typeobj.tp_name()
+        self.tp_flags = typeobj.read_field('tp_flags')
+        self.tp_dictoffset = typeobj.read_field('tp_dictoffset')
+        self.tp_basicsize = typeobj.read_field('tp_basicsize')
+        self.tp_itemsize = typeobj.read_field('tp_itemsize')
+        self.cls = PyObjectPtr.subclass_from_type(typeobj)
+        self._key = self._read_key(typeobj)
+        self._gdb_type = None
+
+    @staticmethod
+    def _read_key(typeobj):
+        return tuple([typeobj.read_field(name)
+                      for name in ('tp_name', 'tp_basicsize', 'tp_itemsize',
+                                   'tp_dictoffset')])
+
+    def wrapper(self, cls):
+        """
+        Get the PyObjectPtr subclass to wrap objects of this type when asked
+        for by *cls*, which is used for types without a dedicated subclass
+        (as subclass_from_type does)
+        """
+        if self.cls is PyObjectPtr:
+            return cls
+        return self.cls
+
+    def is_valid(self):
+        """
+        Check that the type object is still the one this info was resolved
+        from: the memory of a deallocated heap type can be reused for another
+        type after the inferior was resumed
+        """
+        if self.epoch != memory_cache.epoch:
+            typeobj = PyTypeObjectPtr(address=self.address)
+            if self._read_key(typeobj) != self._key:
+                return False
+            self.epoch = memory_cache.epoch
+        return True
+
+    def gdb_type(self):
+        """Get the gdb pointer type used to cast objects of this type"""
+        if self._gdb_type is None:
+            self._gdb_type = self.cls.get_gdb_type()
+        return self._gdb_type
+
+
+_type_cache = {}
+
+
+def get_type_info(address):
+    """
+    Get the PyTypeInfo for the (PyTypeObject*) at *address*, reading the
+    type object from the inferior only the first time it's seen
+    """
+    type_info = _type_cache.get(address)
+    if type_info is None or not type_info.is_valid():
+        if address == 0:
+            raise NullPyObjectPtr(address)
+        type_info = _type_cache[address] = PyTypeInfo(address)
+    return type_info
+
+
+def get_unicode_width():
+    """Get sizeof(Py_UNICODE) in the inferior process: 2 (UCS-2) or 4 (UCS-4)"""
+    if layouts.unicode_width is None:
+        layouts.ensure_loaded()
+        if layouts.unicode_width is None:
+            layouts.unicode_width = gdb.lookup_type('Py_UNICODE').sizeof
+    return layouts.unicode_width
+
+
+def get_digit_size():
+    """Get sizeof(digit) of python longs in the inferior process"""
+    if layouts.digit_size is None:
+        layouts.ensure_loaded()
+        if layouts.digit_size is None:
+            layouts.digit_size = gdb.lookup_type('digit').sizeof
+    return layouts.digit_size
+
+
+def _unichr(ucs):
+    try:
+        return unichr(ucs)
+    except ValueError:
+        # e.g. a UCS-4 code point in a gdb built with a narrow python
+        return u'\ufffd'
+
 
 class PyUnicodeObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PyUnicodeObject'
 
-    def proxyval(self, visited):
+    def read_unicode(self, maxlen=None):
+        """
+        Read the Py_UNICODE buffer with a single memory read and decode it;
+        if *maxlen* is given only that many leading code units are read
+        """
         # From unicodeobject.h:
         #     Py_ssize_t length;  /* Length of raw Unicode data in buffer */
         #     Py_UNICODE *str;    /* Raw Unicode buffer */
-        field_length = long(self.field('length'))
-        field_str = self.field('str')
-
-        # Gather a list of ints from the Py_UNICODE array; these are either
-        # UCS-2 or UCS-4 code points:
-        Py_UNICODEs = [int(field_str[i]) for i in safe_range(field_length)]
-
-        # Convert the int code points to unicode characters, and generate a
-        # local unicode instance:
-        result = u''.join([unichr(ucs) for ucs in Py_UNICODEs])
-        return result
+        width = get_unicode_width()
+        field_length = max(0, min(self.read_field('length'),
+                                  MAX_READ_SIZE // width))
+        if maxlen is not None:
+            field_length = min(field_length, maxlen)
+        data = read_memory(self.read_field('str'), field_length * width)
+
+        # The buffer holds either UCS-2 or UCS-4 code units, which decode as
+        # UTF-16 or UTF-32 in the byte order of the inferior:
+        if width == 2:
+            encoding = 'utf-16'
+        else:
+            encoding = 'utf-32'
+        if get_byteorder() == '>':
+            encoding += '-be'
+        else:
+            encoding += '-le'
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            # Lone surrogates, invalid code points or a prefix ending inside
+            # a surrogate pair: convert the code units one by one
+            Py_UNICODEs = struct.unpack('%s%d%s' % (
+                get_byteorder(), field_length, 'H' if width == 2 else 'I'),
+                data)
+            return u''.join([_unichr(ucs) for ucs in Py_UNICODEs])
 
+    def proxyval(self, visited):
+        return self.read_unicode()
 
-def int_from_int(gdbval):
-    return int(str(gdbval))
+    def write_repr(self, out, visited):
+        # As for PyStringObjectPtr, only read what still fits in "out"
+        remaining = getattr(out, 'remaining', None)
+        if remaining is not None:
+            remaining = remaining()
+        out.write(repr(self.read_unicode(remaining)))
 
 
 class Frame(object):
     """
     Wrapper for gdb.Frame, adding various methods
+
+    Frames of the selected thread know their index in the StackSnapshot of
+    the current stop, which is used to navigate the stack without walking
+    it with gdb again.
     """
+    __slots__ = ('_gdbframe', '_index', '_key', '_is_evalframeex')
 
-    def __init__(self, gdbframe):
+    def __init__(self, gdbframe, index=None, key=None):
         self._gdbframe = gdbframe
+        self._index = index
+        self._key = key
+        self._is_evalframeex = None
+
+    def _snapshot_index(self):
+        # Get the index of this frame in the current StackSnapshot, or None
+        # if it isn't part of it (e.g. a frame of another thread)
+        snapshot = get_stack_snapshot()
+        if self._key != snapshot.key:
+            self._index = snapshot.index_of(self._gdbframe)
+            self._key = snapshot.key
+        return self._index
 
     def older(self):
+        index = self._snapshot_index()
+        if index is not None:
+            return get_stack_snapshot().frame(index + 1)
         older = self._gdbframe.older()
         if older:
             return Frame(older)
@@ -1113,6 +2539,9 @@ class Frame(object):
             return None
 
     def newer(self):
+        index = self._snapshot_index()
+        if index is not None:
+            return get_stack_snapshot().frame(index - 1)
         newer = self._gdbframe.newer()
         if newer:
             return Frame(newer)
@@ -1121,19 +2550,30 @@ class Frame(object):
 
     def select(self):
         self._gdbframe.select()
+        index = self._snapshot_index()
+        if index is not None:
+            get_stack_snapshot().selected = index
 
     def get_index(self):
         """Calculate index of frame, starting at 0 for the newest frame within
         this thread"""
+        index = self._snapshot_index()
+        if index is not None:
+            return index
         index = 0
         # Go down until you reach the newest frame:
-        iter_frame = self
+        iter_frame = self._gdbframe
         while iter_frame.newer():
             index += 1
             iter_frame = iter_frame.newer()
         return index
 
     def is_evalframeex(self):
+        if self._is_evalframeex is None:
+            self._is_evalframeex = self._check_evalframeex()
+        return self._is_evalframeex
+
+    def _check_evalframeex(self):
         if self._gdbframe.function():
             if self._gdbframe.function().name == 'PyEval_EvalFrameEx':
                 """
@@ -1158,6 +2598,10 @@ class Frame(object):
 
     @classmethod
     def get_selected_frame(cls):
+        snapshot = get_stack_snapshot()
+        index = snapshot.selected_index()
+        if index is not None:
+            return snapshot.frame(index)
         _gdbframe = gdb.selected_frame()
         if _gdbframe:
             return Frame(_gdbframe)
@@ -1167,6 +2611,11 @@ class Frame(object):
     def get_selected_python_frame(cls):
         """Try to obtain the Frame for the python code in the selected frame,
         or None"""
+        snapshot = get_stack_snapshot()
+        index = snapshot.selected_index()
+        if index is not None:
+            return snapshot.frame(snapshot.python_frame_index(index, True))
+
         frame = cls.get_selected_frame()
 
         while frame:
@@ -1177,41 +2626,269 @@ class Frame(object):
         # Not found:
         return None
 
-    def print_summary(self):
+    def print_summary(self, maxlen=MAX_OUTPUT_LEN, out=None):
+        if out is None:
+            out = sys.stdout
         if self.is_evalframeex():
-            pyop = self.get_pyop()
-            if pyop:
-                sys.stdout.write('#%i %s\n' % (
-                    self.get_index(), pyop.get_truncated_repr(MAX_OUTPUT_LEN)))
-                sys.stdout.write(pyop.current_line())
-            else:
-                sys.stdout.write(
-                    '#%i (unable to read python frame information)\n'
-                    % self.get_index())
+            print_pyframe_summary(self.get_index(), self.get_pyop(),
+                                  maxlen, out)
         else:
-            sys.stdout.write('#%i\n' % self.get_index())
+            out.write('#%i\n' % self.get_index())
+
+
+def print_pyframe_summary(index, pyop, maxlen=MAX_OUTPUT_LEN, out=None):
+    """Write the summary of python frame *pyop*, numbered *index*"""
+    if out is None:
+        out = sys.stdout
+    if pyop:
+        out.write('#%i ' % index)
+        pyop.write_truncated_repr(out, maxlen)
+        out.write('\n')
+        out.write(pyop.current_line())
+    else:
+        out.write('#%i (unable to read python frame information)\n' % index)
+
+
+class StackSnapshot(object):
+    """
+    The native frames of the selected thread at one stop, indexed from 0
+    for the newest frame. gdb unwinds the stack only as far as a lookup
+    needs, and each frame is unwound and classified as PyEval_EvalFrameEx
+    or not at most once, so that moving between python frames doesn't
+    walk the stack again.
+
+    Taken by get_stack_snapshot, and valid until the inferior runs (see
+    MemoryCache.epoch) or another thread is selected.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.frames = []
+        # The next gdb.Frame to unwind, False once the stack is complete
+        self._older = None
+        self.selected = None
+
+    def _unwind_to(self, index):
+        # Unwind frames up to *index*, returning False if the stack is
+        # shorter than that
+        while len(self.frames) <= index:
+            if self._older is None:
+                gdbframe = gdb.newest_frame()
+            elif self._older is False:
+                return False
+            else:
+                gdbframe = self._older.older()
+            if not gdbframe:
+                self._older = False
+                return False
+            self.frames.append(Frame(gdbframe, len(self.frames), self.key))
+            self._older = gdbframe
+        return True
+
+    def frame(self, index):
+        """Get the Frame at *index*, or None if out of range"""
+        if index is None or index < 0 or not self._unwind_to(index):
+            return None
+        return self.frames[index]
+
+    def index_of(self, gdbframe):
+        """Get the index of gdb.Frame *gdbframe*, or None if not found"""
+        index = 0
+        while self._unwind_to(index):
+            if self.frames[index]._gdbframe == gdbframe:
+                return index
+            index += 1
+        return None
+
+    def selected_index(self):
+        """Get the index of gdb's selected frame"""
+        try:
+            gdbframe = gdb.selected_frame()
+        except gdb.error:
+            return None
+        # The frame selected through the snapshot, or the newest frame
+        # after a stop, are checked before searching
+        for index in (self.selected, 0):
+            frame = self.frame(index)
+            if frame is not None and frame._gdbframe == gdbframe:
+                self.selected = index
+                return index
+        self.selected = self.index_of(gdbframe)
+        return self.selected
+
+    def python_frame_index(self, index, older):
+        """
+        Get the index of the first eval frame at *index* or beyond in the
+        direction given by *older*, or None if there is none
+        """
+        if index is None or index < 0 or not self._unwind_to(index):
+            return None
+        step = 1 if older else -1
+        while 0 <= index and self._unwind_to(index):
+            if self.frames[index].is_evalframeex():
+                return index
+            index += step
+        return None
+
+    def find_python_frame(self, address):
+        """
+        Get the index of the eval frame evaluating the (PyFrameObject*) at
+        *address*, or None if there is none
+        """
+        index = self.python_frame_index(0, True)
+        while index is not None:
+            pyop = self.frames[index].get_pyop()
+            if pyop and pyop.as_address() == address:
+                return index
+            index = self.python_frame_index(index + 1, True)
+        return None
+
+
+_stack_snapshot = None
+
+
+def get_stack_snapshot():
+    """Get the StackSnapshot of the selected thread at the current stop"""
+    global _stack_snapshot
+    thread = gdb.selected_thread()
+    key = (memory_cache.epoch, thread and thread.ptid)
+    if _stack_snapshot is None or _stack_snapshot.key != key:
+        _stack_snapshot = StackSnapshot(key)
+    return _stack_snapshot
+
+
+class ThreadState(object):
+    """
+    A PyThreadState of the inferior process. The python frames of the
+    thread are found by following tstate->frame and f_back with memory
+    reads only, without unwinding the native stack with gdb.
+    """
+    __slots__ = ('address', 'thread_id', 'frame')
+
+    def __init__(self, address):
+        layout = get_layout('PyThreadState')
+        data = layout.read(address)
+        self.address = address
+        # The pthread id (see PyThread_get_thread_ident)
+        self.thread_id = layout.unpack(data, 'thread_id') \
+            & ((1 << (8 * SIZEOF_VOID_P)) - 1)
+        self.frame = layout.unpack(data, 'frame')
+
+    def iter_frames(self):
+        """
+        Yields a PyFrameObjectPtr for each python frame of the thread,
+        starting with the newest one
+        """
+        seen = set()
+        address = self.frame
+        while address and address not in seen:
+            seen.add(address)
+            pyop = PyFrameObjectPtr(address=address)
+            yield pyop
+            address = pyop.f_back
+
+
+_interp_head_address = None
+
+
+def get_interp_head():
+    """Get the address of the first PyInterpreterState (interp_head of
+    Python/pystate.c), or 0 if it can't be found"""
+    global _interp_head_address
+    if _interp_head_address is None:
+        _interp_head_address = 0
+        for expr in ("&'pystate.c'::interp_head", '&interp_head'):
+            try:
+                _interp_head_address = long(gdb.parse_and_eval(expr))
+                break
+            except RuntimeError:
+                pass
+    if not _interp_head_address:
+        return 0
+    return read_pointers(_interp_head_address, 1)[0]
+
+
+def iter_interpreters():
+    """Yields the address of each PyInterpreterState of the inferior
+    process"""
+    interp_layout = get_layout('PyInterpreterState')
+    seen = set()
+    interp = get_interp_head()
+    while interp and interp not in seen:
+        seen.add(interp)
+        yield interp
+        interp = interp_layout.read_field(interp, 'next')
+
+
+def iter_thread_states():
+    """Yields a ThreadState for each thread of each python interpreter of
+    the inferior process"""
+    interp_layout = get_layout('PyInterpreterState')
+    tstate_layout = get_layout('PyThreadState')
+    seen = set()
+    for interp in iter_interpreters():
+        tstate = interp_layout.read_field(interp, 'tstate_head')
+        while tstate and tstate not in seen:
+            seen.add(tstate)
+            yield ThreadState(tstate)
+            tstate = tstate_layout.read_field(tstate, 'next')
+
+
+def get_selected_thread_id():
+    """Get the pthread id of gdb's selected thread, or None if unknown"""
+    try:
+        thread_info = gdb.execute('thread', to_string=True)
+    except gdb.error:
+        return None
+    m = re.search(r'Thread (0x[0-9a-fA-F]+)', thread_info)
+    if m:
+        return int(m.group(1), 16)
+    return None
+
+
+def get_selected_thread_state():
+    """Get the ThreadState of gdb's selected thread, or None"""
+    thread_id = get_selected_thread_id()
+    tstates = list(iter_thread_states())
+    for tstate in tstates:
+        if tstate.thread_id == thread_id:
+            return tstate
+    if len(tstates) == 1:
+        # e.g. a target where threads aren't shown by pthread id
+        return tstates[0]
+    return None
+
+
+def select_pyframe(pyop):
+    """
+    Select the native PyEval_EvalFrameEx frame evaluating python frame
+    *pyop* of the selected thread, returning its Frame or None if not found.
+    This is the only point where the native stack is unwound.
+    """
+    snapshot = get_stack_snapshot()
+    frame = snapshot.frame(snapshot.find_python_frame(pyop.as_address()))
+    if frame:
+        frame.select()
+    return frame
 
 
 def move_in_stack(move_up, silently=False):
     """Move up or down the stack (for the py-up/py-down command)"""
-    frame = Frame.get_selected_python_frame()
-    while frame:
+    snapshot = get_stack_snapshot()
+    index = snapshot.python_frame_index(snapshot.selected_index(), True)
+    if index is not None:
         if move_up:
-            iter_frame = frame.older()
+            index = snapshot.python_frame_index(index + 1, True)
         else:
-            iter_frame = frame.newer()
+            index = snapshot.python_frame_index(index - 1, False)
 
-        if not iter_frame:
-            break
-
-        if iter_frame.is_evalframeex():
-            # Result:
-            iter_frame.select()
-            if not silently:
-                iter_frame.print_summary()
-            return True
-
-        frame = iter_frame
+    if index is not None:
+        # Result:
+        iter_frame = snapshot.frame(index)
+        iter_frame.select()
+        if not silently:
+            iter_frame.print_summary()
+        return True
 
     if not silently:
         if move_up:
@@ -1220,3 +2897,65 @@ def move_in_stack(move_up, silently=False):
             print 'Unable to find a newer python frame'
 
     return False
+
+
+def clear_caches(event=None):
+    """
+    Drop everything cached about the inferior process, e.g. when objfiles
+    are (re)loaded or the inferior exits
+    """
+    global _set_dummy, _hash_secret, _stack_snapshot, _interp_head_address
+    memory_cache.flush()
+    _type_cache.clear()
+    _code_cache.clear()
+    _set_dummy = None
+    _hash_secret = None
+    _stack_snapshot = None
+    _interp_head_address = None
+
+
+def handle_new_objfile(event):
+    """Resolve the layout registry when libpython is loaded"""
+    clear_caches()
+    filename = getattr(event.new_objfile, 'filename', None) or ''
+    if 'python' in os.path.basename(filename):
+        try:
+            layouts.load()
+        except RuntimeError:
+            # e.g. no debug info for this objfile; resolved on first use
+            layouts.reset()
+
+
+def handle_clear_objfiles(event):
+    clear_caches()
+    layouts.reset()
+
+
+_event_handlers = []
+
+
+def connect_events():
+    """Connect the gdb event handlers that keep the caches of this module
+    in sync with the inferior process"""
+    disconnect_events()
+    for name, handler in (('new_objfile', handle_new_objfile),
+                          ('clear_objfiles', handle_clear_objfiles),
+                          ('exited', clear_caches),
+                          ('cont', memory_cache.flush),
+                          ('inferior_call', memory_cache.flush),
+                          ('memory_changed', memory_cache.flush)):
+        registry = getattr(gdb.events, name, None)
+        if registry is not None:
+            registry.connect(handler)
+            _event_handlers.append((registry, handler))
+
+
+def disconnect_events():
+    """Disconnect the gdb event handlers of this module, used before the
+    module is reloaded (see py-init in .gdbinit)"""
+    while _event_handlers:
+        registry, handler = _event_handlers.pop()
+        registry.disconnect(handler)
+
+
+connect_events()
@@ -27,13 +27,46 @@
 
 """GDB console python extension functions"""
 
+import os
+import re
 import sys
 import gdb
-from pygdb.console.core import Frame, move_in_stack, \
-    PyDictObjectPtr, PyInstanceObjectPtr, HeapTypeObjectPtr
+from ast import literal_eval
+from pygdb.console.core import Frame, move_in_stack, memory_cache, \
+    PyObjectPtr, PyDictObjectPtr, PyInstanceObjectPtr, HeapTypeObjectPtr, \
+    PyListObjectPtr, PyTupleObjectPtr, get_selected_thread_state, \
+    iter_interpreters, iter_thread_states, print_pyframe_summary, \
+    select_pyframe, ThreadState, get_layout, read_array, read_pointers, \
+    read_string, struct_format, write_memory, write_pointer, write_scalar, \
+    MAX_OUTPUT_LEN
 
 __breakpoint_identifier = '_pygdb_breakpoint_mark'
 __breakpoint_func = '_pygdb.breakpoint_mark()'
+__step_hook = '_pygdb_breakpoint_step'
+__pybreak_identifier = '_pygdb_breakpoint_line'
+__thread_start_identifier = 'PyEval_AcquireThread'
+
+# Step modes of the _pygdb_trace C trace function, see pygdb/_breakpoint.c
+STEP_OFF = 0
+STEP_LINE = 1
+STEP_NEXT = 2
+STEP_RETURN = 3
+
+# Sizes of the py-break tables of _pygdb, see pygdb/_breakpoint.c
+MAX_BREAKS = 64
+MAX_BREAK_PATH = 1024
+
+# Number of entries of the named breakpoint tables of _pygdb
+MAX_NAMED = 256
+
+# The py-break breakpoints as (number, file name, line number) in the
+# order of the _pygdb tables, the last number given, and the gdb
+# breakpoints on their hook in _pygdb and on thread start (see
+# NewThreadHook) while there are any
+pybreaks = []
+pybreak_number = 0
+pybreak_hook = None
+thread_hook = None
 
 
 def term_color(*v):
@@ -73,6 +106,9 @@ def inject_pyframe(cmd, silently=False):
     gdb.execute("call PyRun_SimpleString(\"%s\")" % cmd)
     gdb.execute("call PyGILState_Release(%s)" % gstate)
 
+    # The injected code may have changed anything in the inferior
+    memory_cache.flush()
+
 
 def get_pyframe_f_back(silently=False):
     """Get id of parent pyframe"""
@@ -102,13 +138,66 @@ def get_selected_pyop(silently=False):
     return pyop
 
 
+__pyobject_name_re = re.compile(r'\s*([A-Za-z_]\w*)')
+__pyobject_path_re = re.compile(
+    r"""\s*(?:\.\s*(\w+)"""
+    r"""|\[\s*(-?\d+|u?'(?:[^'\\]|\\.)*'|u?"(?:[^"\\]|\\.)*")\s*\])""")
+
+
+def parse_pyobject_name(name):
+    """Split *name* on the form x.y['key'][3] into the variable name and a
+    list of the keys or indexes to look up in turn, or returns None if
+    *name* can't be parsed"""
+
+    m = __pyobject_name_re.match(name)
+    if not m:
+        return None
+    path = []
+    pos = m.end()
+    while pos < len(name.rstrip()):
+        m_path = __pyobject_path_re.match(name, pos)
+        if not m_path:
+            return None
+        (attr, index) = m_path.groups()
+        if attr is not None:
+            path.append(attr)
+        else:
+            path.append(literal_eval(index))
+        pos = m_path.end()
+
+    return (m.group(1), path)
+
+
+def get_pyobject_item(pyop, key):
+    """Returns the pyobject value for *key* of dict, list or tuple *pyop*,
+    or for attribute *key* of an object, or None if not found"""
+
+    if isinstance(pyop, PyDictObjectPtr):
+        return pyop.get_item(key)
+    elif isinstance(pyop, (PyListObjectPtr, PyTupleObjectPtr)):
+        if not isinstance(key, (int, long)):
+            return None
+        try:
+            return PyObjectPtr.from_address(pyop[key])
+        except IndexError:
+            return None
+    elif isinstance(pyop, (PyInstanceObjectPtr, HeapTypeObjectPtr)):
+        if not isinstance(key, basestring):
+            return None
+        return pyop.get_attr(key)
+
+    return None
+
+
 def get_pyobject_value(name):
     """Returns pyobject value for *name*,
-    supports nested pyobject values are supported"""
+    supports nested pyobject values using dots (x.y) for dictionary keys
+    and attributes and brackets (x['key'], x[3]) for keys and indexes"""
 
-    name_arr = name.split('.')
-    name_arr_len = len(name_arr)
-    first_name = name_arr[0]
+    parsed = parse_pyobject_name(name)
+    if parsed is None:
+        return (None, None)
+    (first_name, path) = parsed
 
     pyop_frame = get_selected_pyop()
     if not pyop_frame:
@@ -118,30 +207,28 @@ def get_pyobject_value(name):
     if not pyop_var:
         return (scope, None)
 
+    # Look up each key on its own, probing the containers without reading
+    # the rest of them
     cur_value = pyop_var
-    for i in xrange(1, name_arr_len):
-        next_name = name_arr[i]
-        pyop_var_dict = None
-        if isinstance(cur_value, PyDictObjectPtr):
-            pyop_var_dict = pyop_var
-        elif isinstance(cur_value, PyInstanceObjectPtr):
-            pyop_var_dict = pyop_var.pyop_field('in_dict')
-        elif isinstance(cur_value, HeapTypeObjectPtr):
-            pyop_var_dict = cur_value.get_attr_dict()
-        else:
-            return (scope, None)
-        cur_value = None
-        if pyop_var_dict:
-            # NOTE: pyop_var_dict does not support __getitem__
-            for key, value in pyop_var_dict.iteritems():
-                if str(key) == next_name:
-                    cur_value = value
+    for key in path:
+        cur_value = get_pyobject_item(cur_value, key)
         if cur_value is None:
             break
 
     return (scope, cur_value)
 
 
+def lazy_value(name):
+    """Returns a lazy proxy (see PyObjectPtr.lazyval) of the python value
+    for *name* as resolved by get_pyobject_value, for scripts navigating
+    big structures in the inferior. Raises NameError if it's not found"""
+
+    (_, pyop_value) = get_pyobject_value(name)
+    if pyop_value is None:
+        raise NameError(name)
+    return pyop_value.lazyval()
+
+
 def breakpoint_frame(silently=False):
     """Move to python frame with active breakpoint"""
 
@@ -175,6 +262,119 @@ def breakpoint_caller_frame(silently=False):
     return status
 
 
+def backtrace_pyframes(maxlen, out):
+    """
+    Display the python frames of the selected thread read from its
+    PyThreadState, numbered from 0 for the newest python frame, without
+    unwinding the native stack. Returns False if the thread state of the
+    selected thread is not found.
+    """
+    tstate = get_selected_thread_state()
+    if tstate is None:
+        return False
+    for (index, pyop) in enumerate(tstate.iter_frames()):
+        print_pyframe_summary(index, pyop, maxlen, out)
+    return True
+
+
+def backtrace_all_threads(out):
+    """
+    Display the python stack of every thread in one pass over the thread
+    states, without switching threads in gdb. Threads with identical
+    stacks are displayed once, with their count and python thread idents.
+    Returns False if no thread states are found.
+    """
+    stacks = {}
+    order = []
+    frames = {}
+    for tstate in iter_thread_states():
+        stack = []
+        for pyop in tstate.iter_frames():
+            if pyop.is_optimized_out():
+                continue
+            key = (pyop.co.as_address(), pyop.current_line_num())
+            if key not in frames:
+                frames[key] = (pyop.filename(),
+                               pyop.co_name.proxyval(set()))
+            stack.append(key)
+        stack = tuple(stack)
+        if stack not in stacks:
+            stacks[stack] = []
+            order.append(stack)
+        stacks[stack].append(tstate.thread_id)
+
+    if not order:
+        return False
+
+    source = {}
+    for stack in order:
+        thread_ids = stacks[stack]
+        out.write('%d thread(s): %s\n'
+                  % (len(thread_ids),
+                     ', '.join('0x%x' % ident for ident in thread_ids)))
+        if not stack:
+            out.write('  (no python frames)\n')
+        for key in stack:
+            (filename, name) = frames[key]
+            lineno = key[1]
+            out.write('  File "%s", line %s, in %s\n'
+                      % (filename, lineno, name))
+            line = get_source_line(filename, lineno, source)
+            if line is not None:
+                out.write('    %s\n' % line.strip())
+        out.write('\n')
+    return True
+
+
+def get_source_line(filename, lineno, source):
+    """
+    Get line *lineno* (1-based) of source file *filename*, or None if it
+    can't be read. The lines of each file are read once and kept in the
+    dict *source*, for as long as the caller keeps it.
+    """
+    if filename not in source:
+        try:
+            with open(filename, 'r') as fh:
+                source[filename] = fh.readlines()
+        except IOError:
+            source[filename] = []
+    lines = source[filename]
+    if lineno and 0 < lineno <= len(lines):
+        return lines[lineno-1]
+    return None
+
+
+def is_step_target(pyop, skip_breakpoint_mark, file_prefix, source):
+    """
+    Check if python frame *pyop* is at a line to stop at when stepping:
+    not a breakpoint mark (if *skip_breakpoint_mark*) and within
+    *file_prefix* (if given)
+    """
+    filepath = pyop.filename()
+    if file_prefix and not filepath.startswith(file_prefix):
+        return False
+    if skip_breakpoint_mark:
+        line = get_source_line(filepath, pyop.current_line_num(), source)
+        if line is not None and line.strip() == __breakpoint_func:
+            return False
+    return True
+
+
+def select_pyframe_index(index):
+    """
+    Select python frame *index* of the selected thread, as numbered by
+    backtrace_pyframes, and the native frame evaluating it.
+    Returns False if there is no such frame.
+    """
+    tstate = get_selected_thread_state()
+    if tstate is None:
+        return False
+    for (pyindex, pyop) in enumerate(tstate.iter_frames()):
+        if pyindex == index:
+            return select_pyframe(pyop) is not None
+    return False
+
+
 def list_pyframe(start=None, end=None):
     """List current python frame with active code line highlighted"""
     show_lines = 30
@@ -222,6 +422,7 @@ def attach(pid):
 
     # Delete old breakpoints
     gdb.execute('delete breakpoints')
+    clear_pybreaks()
 
     # Attach process
     gdb.execute('attach %d' % pid)
@@ -236,6 +437,112 @@ def attach(pid):
     breakpoint_list()
 
 
+def ensure_mark_breakpoint():
+    """
+    Add the gdb breakpoint at _pygdb_breakpoint_mark, where armed named
+    breakpoints stop, unless one is set already (e.g. by py-attach)
+    """
+    for breakpoint in gdb.breakpoints() or ():
+        if breakpoint.is_valid() and breakpoint.enabled \
+                and breakpoint.location == __breakpoint_identifier:
+            return
+    gdb.execute('break %s' % __breakpoint_identifier)
+
+
+def detach(num):
+    """
+    Remove the py-break breakpoints and disarm the named breakpoints of
+    inferior *num*, which would otherwise keep tracing every line or
+    calling the mark of the detached process, and detach it
+    """
+    gdb.execute('inferior %d' % num, to_string=True)
+    try:
+        clear_pybreaks()
+        arm_named_breakpoint('*', armed=False)
+    except gdb.error:
+        # e.g. no process or no _pygdb
+        pass
+    gdb.execute('detach inferior %d' % num)
+
+
+def read_named_breakpoints():
+    """
+    Read the named breakpoints of _pygdb in the inferior (see
+    pygdb.breakpoint.set) as a list of (name, armed, hits) indexed by id,
+    or None if _pygdb isn't loaded
+    """
+    count = get_symbol_address('&_pygdb_named_count')
+    names = get_symbol_array('_pygdb_named_names')
+    armed = get_symbol_array('_pygdb_named_armed')
+    hits = get_symbol_array('_pygdb_named_hits')
+    if not count or not names or not armed or not hits:
+        return None
+    count = min(read_array(count, 'i', 1)[0], MAX_NAMED)
+    (names, name_size, _) = names
+    armed = read_array(armed[0], armed[2], count)
+    hits = read_array(hits[0], hits[2], count)
+    return [(read_string(names + name_size * index, name_size),
+             bool(armed[index]), hits[index])
+            for index in xrange(count)]
+
+
+def list_named_breakpoints():
+    """Display the named breakpoints reached so far, and their hit counts"""
+    named = read_named_breakpoints()
+    if named is None:
+        print "Unable to find the _pygdb named breakpoints of the inferior"
+        return
+    if not named:
+        print "No named breakpoints reached"
+        return
+    print "Id\tState\t\tHits\tName"
+    for (index, (name, armed, hits)) in enumerate(named):
+        if armed:
+            state = 'armed'
+        else:
+            state = 'disarmed'
+        print "%d\t%-8s\t%d\t%s" % (index, state, hits, name)
+
+
+def arm_named_breakpoint(name, armed=True):
+    """
+    Arm (or disarm) the named breakpoint *name*, or all of them for '*', by
+    writing its flag in the inferior, without resuming it. A name not
+    reached yet is added to the tables, so that it is armed the first
+    time the inferior reaches it. Names are compared as truncated by
+    _pygdb. Arming also adds the gdb breakpoint the named breakpoints
+    stop at, if missing. Returns the number of breakpoints changed
+    """
+    named = read_named_breakpoints()
+    if named is None:
+        return 0
+    if armed:
+        ensure_mark_breakpoint()
+    (address, size, fmt) = get_symbol_array('_pygdb_named_armed')
+    (names, name_size, _) = get_symbol_array('_pygdb_named_names')
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    name = name[:name_size - 1]
+    changed = 0
+    for (index, (named_name, _, _)) in enumerate(named):
+        if name == '*' or name == named_name:
+            write_scalar(address + size * index, fmt, int(armed))
+            changed += 1
+    if changed or name == '*' or not armed:
+        return changed
+
+    # Add the entry, as _pygdb does when a name is first reached
+    index = len(named)
+    if index >= MAX_NAMED or '\0' in name:
+        return 0
+    (hits, hits_size, hits_fmt) = get_symbol_array('_pygdb_named_hits')
+    write_memory(names + name_size * index, name + '\0')
+    write_scalar(address + size * index, fmt, 1)
+    write_scalar(hits + hits_size * index, hits_fmt, 0)
+    write_scalar(get_symbol_address('&_pygdb_named_count'), 'i', index + 1)
+    return 1
+
+
 def list_threads():
     """List all threads for attached process"""
     # NOTE: threads[-1] is main thread
@@ -277,8 +584,241 @@ def breakpoint_list(threadid=None, silently=False):
 
 def breakpoint_continue():
     """Continue until next breakpoint and display it"""
+    arm_pybreaks()
     gdb.execute('continue')
-    breakpoint_list()
+    if not pybreak_stop():
+        breakpoint_list()
+
+
+def parse_pybreak_location(location):
+    """
+    Split *location* on the form FILE:LINE into the file name and the line
+    number, raises ValueError if it is malformed
+    """
+    (filename, sep, lineno) = location.strip().rpartition(':')
+    filename = filename.strip()
+    if not sep or not filename or len(filename) >= MAX_BREAK_PATH:
+        raise ValueError("Invalid breakpoint location: %s" % location)
+    lineno = int(lineno)
+    if lineno < 1:
+        raise ValueError("Invalid breakpoint line: %s" % lineno)
+    return (filename, lineno)
+
+
+def pybreak_file_matches(filename, pattern):
+    """
+    Check if *pattern* matches *filename* as a py-break location does in
+    _pygdb: the whole path, or a trailing part of it starting at a
+    directory
+    """
+    if not pattern or not filename.endswith(pattern):
+        return False
+    return len(pattern) == len(filename) or pattern[0] == '/' \
+        or filename[-len(pattern)-1] == '/'
+
+
+def iter_module_files():
+    """
+    Yields the source file (__file__) of each module imported by the python
+    interpreters of the inferior, if gdb knows the PyModuleObject type
+    """
+    try:
+        module_layout = get_layout('PyModuleObject')
+    except RuntimeError:
+        return
+    interp_layout = get_layout('PyInterpreterState')
+    for interp in iter_interpreters():
+        modules = PyObjectPtr.from_address(
+            interp_layout.read_field(interp, 'modules'))
+        if not isinstance(modules, PyDictObjectPtr):
+            continue
+        for (_, module) in modules.iteritems():
+            if module.safe_tp_name() != 'module':
+                continue
+            md_dict = PyObjectPtr.from_address(
+                module_layout.read_field(module.as_address(), 'md_dict'))
+            if not isinstance(md_dict, PyDictObjectPtr):
+                continue
+            filename = md_dict.get_item('__file__')
+            if filename is not None:
+                filename = filename.proxyval(set())
+                if isinstance(filename, basestring):
+                    if filename.endswith(('.pyc', '.pyo')):
+                        filename = filename[:-1]
+                    yield filename
+
+
+def is_pybreak_file_loaded(pattern):
+    """
+    Check if python code from a file matching the py-break file name
+    *pattern* is loaded in the inferior: running in a frame of a thread,
+    or the source file of an imported module
+    """
+    for tstate in iter_thread_states():
+        for pyop in tstate.iter_frames():
+            if not pyop.is_optimized_out() \
+                    and pybreak_file_matches(pyop.filename(), pattern):
+                return True
+    for filename in iter_module_files():
+        if pybreak_file_matches(filename, pattern):
+            return True
+    return False
+
+
+def write_pybreaks():
+    """
+    Write the py-break breakpoints to the tables of _pygdb in the inferior.
+    Returns False if _pygdb isn't loaded
+    """
+    count = get_symbol_address('&_pygdb_break_count')
+    lines = get_symbol_array('_pygdb_break_lines')
+    files = get_symbol_array('_pygdb_break_files')
+    if not count or not lines or not files:
+        return False
+    (lines, line_size, line_fmt) = lines
+    (files, file_size, _) = files
+    for (index, (_, filename, lineno)) in enumerate(pybreaks):
+        write_scalar(lines + line_size * index, line_fmt, lineno)
+        write_memory(files + file_size * index, filename + '\0')
+    write_scalar(count, 'i', len(pybreaks))
+    return True
+
+
+class NewThreadHook(gdb.Breakpoint):
+    """
+    Internal breakpoint where a new python thread state first takes the GIL
+    (PyEval_AcquireThread, e.g. from t_bootstrap of Modules/threadmodule.c).
+    It installs the _pygdb_trace C trace function in the thread for the
+    py-break breakpoints, and lets the inferior run on without stopping
+    """
+
+    def stop(self):
+        if not pybreaks:
+            return False
+        try:
+            address = long(gdb.selected_frame().read_var('tstate'))
+        except (RuntimeError, ValueError):
+            return False
+        if address:
+            # Nothing cached since the last stop is valid any more
+            memory_cache.flush()
+            install_tracer(ThreadState(address))
+        return False
+
+
+def arm_pybreaks():
+    """
+    Install the _pygdb_trace C trace function in all python threads, e.g.
+    threads started since the last time, and break at its hook for the
+    py-break breakpoints, if there are any. Threads started later get it
+    from NewThreadHook
+    """
+    global pybreak_hook
+    global thread_hook
+    if not pybreaks:
+        return
+    for tstate in iter_thread_states():
+        # Threads already traced by others, e.g. sys.settrace, are skipped
+        install_tracer(tstate)
+    if pybreak_hook is None or not pybreak_hook.is_valid():
+        pybreak_hook = gdb.Breakpoint(__pybreak_identifier, internal=True)
+    if thread_hook is None or not thread_hook.is_valid():
+        thread_hook = NewThreadHook(__thread_start_identifier, internal=True)
+
+
+def add_pybreak(location):
+    """
+    Add a breakpoint at the python source line *location* on the form
+    FILE:LINE, where FILE may be a trailing part of the path, e.g.
+    pkg/module.py:42. Returns the breakpoint number, which stays the same
+    when other breakpoints are deleted, or None if it can't be set
+    """
+    global pybreak_number
+    (filename, lineno) = parse_pybreak_location(location)
+    if len(pybreaks) >= MAX_BREAKS:
+        print "Unable to set more than %d python breakpoints" % MAX_BREAKS
+        return None
+    pybreaks.append((pybreak_number + 1, filename, lineno))
+    if not write_pybreaks():
+        pybreaks.pop()
+        print "Unable to find the _pygdb breakpoint tables of the inferior"
+        return None
+    pybreak_number += 1
+    arm_pybreaks()
+
+    # The breakpoint is kept, e.g. for a module not imported yet, but a
+    # mistyped or relative path would otherwise never stop
+    warning = None
+    if not is_pybreak_file_loaded(filename):
+        warning = "No loaded python code from a file matching: %s" \
+            % filename
+    elif os.path.isfile(filename) \
+            and get_source_line(filename, lineno, {}) is None:
+        warning = "%s has no line %d" % (filename, lineno)
+    if warning:
+        sys.stdout.write(term_color(0, 31))
+        print "WARNING: %s" % warning
+        sys.stdout.write(term_color(0))
+    return pybreak_number
+
+
+def delete_pybreak(number):
+    """Delete py-break breakpoint number *number*, returns False if none"""
+    for (index, pybreak) in enumerate(pybreaks):
+        if pybreak[0] == number:
+            break
+    else:
+        return False
+    del pybreaks[index]
+    write_pybreaks()
+    if not pybreaks:
+        clear_pybreaks()
+    return True
+
+
+def clear_pybreaks():
+    """
+    Forget all py-break breakpoints. The tracer removes itself from the
+    threads once it is neither stepping nor has breakpoints to check
+    """
+    global pybreak_hook
+    global thread_hook
+    del pybreaks[:]
+    try:
+        write_pybreaks()
+    except gdb.error:
+        pass
+    for hook in (pybreak_hook, thread_hook):
+        if hook is not None and hook.is_valid():
+            hook.delete()
+    pybreak_hook = None
+    thread_hook = None
+
+
+def list_pybreaks():
+    """Display the py-break breakpoints"""
+    if not pybreaks:
+        print "No python breakpoints"
+    for (number, filename, lineno) in pybreaks:
+        print "%d\t%s:%d" % (number, filename, lineno)
+
+
+def pybreak_stop():
+    """
+    If the selected thread stopped at a py-break breakpoint, select and
+    display its python frame and return True
+    """
+    try:
+        if gdb.newest_frame().name() != __pybreak_identifier:
+            return False
+    except gdb.error:
+        return False
+    gdb.newest_frame().select()
+    index = read_array(get_symbol_address('&_pygdb_stop_break'), 'i', 1)[0]
+    if 0 <= index < len(pybreaks):
+        print "Breakpoint %d, %s:%d" % pybreaks[index]
+    list_pyframe()
+    return True
 
 
 def inspect_pyframe(show_globals=True, show_locals=True):
@@ -381,6 +921,164 @@ def set_pyframe_local(key, value):
     inject_pyframe(cmd)
 
 
+def get_symbol_address(expr):
+    """Get the address given by the gdb expression *expr*, or None"""
+    try:
+        return long(gdb.parse_and_eval(expr))
+    except gdb.error:
+        return None
+
+
+def get_symbol_array(name):
+    """
+    Get the address of the C array variable *name* of the inferior, and
+    the size and struct format character (see struct_format) of its
+    elements as declared, e.g. None for an array of char arrays.
+    Returns None if there is no such variable
+    """
+    try:
+        value = gdb.parse_and_eval(name)
+        address = long(value.address)
+    except gdb.error:
+        return None
+    element = value.type.strip_typedefs().target()
+    return (address, element.sizeof, struct_format(element))
+
+
+def install_tracer(tstate):
+    """
+    Install the _pygdb_trace C trace function (see pygdb/_breakpoint.c) in
+    ThreadState *tstate* by writing the thread state, as PyEval_SetTrace
+    would, without running any code in the inferior. The tracer removes
+    itself once disarmed (see set_step_mode).
+    Returns False if _pygdb isn't loaded or the thread is already traced,
+    e.g. by sys.settrace
+    """
+    trace = get_symbol_address('&_pygdb_trace')
+    tracing_possible = get_symbol_address("&'ceval.c'::_Py_TracingPossible")
+    if not trace or not tracing_possible:
+        return False
+    layout = get_layout('PyThreadState')
+    tracefunc = layout.read_field(tstate.address, 'c_tracefunc')
+    if tracefunc == trace:
+        return True
+    if tracefunc:
+        return False
+    layout.write_field(tstate.address, 'c_traceobj', 0)
+    layout.write_field(tstate.address, 'c_tracefunc', trace)
+    layout.write_field(tstate.address, 'use_tracing', 1)
+    write_scalar(tracing_possible, 'i',
+                 read_array(tracing_possible, 'i', 1)[0] + 1)
+    return True
+
+
+def set_step_mode(mode, pyop=None, tstate=None):
+    """
+    Arm the _pygdb_trace C trace function to stop in *mode* relative to
+    python frame *pyop* of ThreadState *tstate*, or disarm it with STEP_OFF.
+    Other threads still running the tracer never stop for the step.
+    """
+    frame = lineno = tstate_address = 0
+    if pyop is not None:
+        frame = pyop.as_address()
+        lineno = pyop.current_line_num()
+    if tstate is not None:
+        tstate_address = tstate.address
+    write_pointer(get_symbol_address('&_pygdb_step_tstate'), tstate_address)
+    write_pointer(get_symbol_address('&_pygdb_step_frame'), frame)
+    write_scalar(get_symbol_address('&_pygdb_step_lineno'), 'i', lineno)
+    write_scalar(get_symbol_address('&_pygdb_step_mode'), 'i', mode)
+
+
+def disarm_step():
+    """Disarm the _pygdb_trace C trace function, if the inferior is alive"""
+    try:
+        set_step_mode(STEP_OFF)
+    except gdb.error:
+        pass
+
+
+def continue_to_step():
+    """
+    Continue the inferior at full speed until the armed _pygdb_trace stops
+    at its breakpoint hook, and select the newest frame.
+    Returns False if the inferior stopped for another reason
+    """
+    hook = gdb.Breakpoint(__step_hook, internal=True)
+    try:
+        gdb.execute('continue', to_string=True)
+        hit = hook.hit_count > 0
+    finally:
+        hook.delete()
+    gdb.newest_frame().select()
+    return hit
+
+
+def run_traced(mode, pyop, skip_breakpoint_mark=True, file_prefix=None,
+               max_count=10000):
+    """
+    Run the selected thread with the _pygdb_trace C trace function armed in
+    *mode* from python frame *pyop*, until it stops at a python line that is
+    not a breakpoint mark (if *skip_breakpoint_mark*) and is within
+    *file_prefix* (if given), or after *max_count* stops.
+    Returns (stop count, stopped by the tracer, python frame stopped at), or
+    None if the thread can't be traced
+    """
+    tstate = get_selected_thread_state()
+    if tstate is None or not install_tracer(tstate):
+        return None
+    arm_pybreaks()
+
+    count = 0
+    hit = True
+    source = {}
+    try:
+        while count <= max_count:
+            set_step_mode(mode, pyop, tstate)
+            hit = continue_to_step()
+            if not hit:
+                break
+            pyop = get_selected_pyop(silently=True)
+            if not pyop:
+                break
+            count += 1
+            if mode == STEP_RETURN or is_step_target(
+                    pyop, skip_breakpoint_mark, file_prefix, source):
+                break
+    finally:
+        disarm_step()
+
+    return (count, hit, pyop)
+
+
+def run_native(command, pyop, skip_breakpoint_mark=True, file_prefix=None,
+               max_count=10000):
+    """
+    Repeat the native gdb *command* ('step' or 'next') from python frame
+    *pyop* until a different python source line is reached, for threads
+    that can't run the _pygdb_trace C trace function (see run_traced).
+    Returns (step count, True, python frame stopped at)
+    """
+    count = 0
+    source = {}
+    start_filepath = pyop.filename()
+    start_lineno = pyop.current_line_num()
+    while count <= max_count:
+        gdb.execute(command, to_string=True)
+        gdb.newest_frame().select()
+        pyop = get_selected_pyop(silently=True)
+        if not pyop:
+            break
+        count += 1
+        if (pyop.filename() != start_filepath
+                or pyop.current_line_num() != start_lineno) \
+                and is_step_target(pyop, skip_breakpoint_mark, file_prefix,
+                                   source):
+            break
+
+    return (count, True, pyop)
+
+
 def pystep(skip_breakpoint_mark=True,
            file_prefix=None,
            silently=False,
@@ -388,38 +1086,29 @@ def pystep(skip_breakpoint_mark=True,
     """Continue until control reaches a different python source line"""
 
     if scheduler_locking:
-        status = gdb.execute('set scheduler-locking step', to_string=True)
+        status = gdb.execute('set scheduler-locking on', to_string=True)
     else:
         status = gdb.execute('set scheduler-locking off', to_string=True)
     if not silently:
         print status
 
-    step_count = 0
     max_step_count = 10000
     pyop = get_selected_pyop(silently=silently)
     if not pyop:
         return
-    start_filepath = filepath = pyop.filename()
-    start_lineno = lineno = pyop.current_line_num()
-    line = pyop.current_line().strip()
-    while (start_filepath == filepath and start_lineno == lineno) \
-            or (skip_breakpoint_mark and line == __breakpoint_func) \
-            or (file_prefix and not filepath.startswith(file_prefix)):
-        step_msg = gdb.execute('step', to_string=True)
-        gdb.newest_frame().select()
-        pyop = get_selected_pyop(silently=silently)
-        if not pyop:
-            break
-        filepath = pyop.filename()
-        lineno = pyop.current_line_num()
-        line = pyop.current_line().strip()
-        step_count += 1
-        if step_count > max_step_count:
-            break
+    result = run_traced(STEP_LINE, pyop, skip_breakpoint_mark, file_prefix,
+                        max_step_count)
+    if result is None:
+        result = run_native('step', pyop, skip_breakpoint_mark, file_prefix,
+                            max_step_count)
+    (step_count, hit, pyop) = result
 
     if not silently:
         print "#steps: %s" % step_count
-        list_pyframe()
+        if hit:
+            list_pyframe()
+        elif not pybreak_stop():
+            print "Stopped before reaching a new python line"
 
     if step_count > max_step_count:
         sys.stdout.write(term_color(0, 31))
@@ -440,35 +1129,62 @@ def pynext(skip_breakpoint_mark=True,
     if not silently:
         print status
 
-    next_count = 0
     max_next_count = 10000
     pyop = get_selected_pyop(silently=silently)
     if not pyop:
         return
-    start_filepath = filepath = pyop.filename()
-    start_lineno = lineno = pyop.current_line_num()
-    line = pyop.current_line().strip()
-    while (start_filepath == filepath and start_lineno == lineno) \
-            or (skip_breakpoint_mark and line == __breakpoint_func) \
-            or (file_prefix and not filepath.startswith(file_prefix)):
-        next_msg = gdb.execute('next', to_string=True)
-        gdb.newest_frame().select()
-        pyop = get_selected_pyop(silently=silently)
-        if not pyop:
-            break
-        filepath = pyop.filename()
-        lineno = pyop.current_line_num()
-        line = pyop.current_line().strip()
-        next_count += 1
-
-        if next_count > max_next_count:
-            break
+    result = run_traced(STEP_NEXT, pyop, skip_breakpoint_mark, file_prefix,
+                        max_next_count)
+    if result is None:
+        result = run_native('next', pyop, skip_breakpoint_mark, file_prefix,
+                            max_next_count)
+    (next_count, hit, pyop) = result
 
     if not silently:
         print "#next: %s" % next_count
-        list_pyframe()
+        if hit:
+            list_pyframe()
+        elif not pybreak_stop():
+            print "Stopped before reaching a new python line"
 
     if next_count > max_next_count:
         sys.stdout.write(term_color(0, 31))
         print "WARNING: Stopped after max next's: %s" % max_next_count
         sys.stdout.write(term_color(0))
+
+
+def pyfinish(scheduler_locking=False, silently=False):
+    """Continue until the current python frame returns"""
+
+    if scheduler_locking:
+        status = gdb.execute('set scheduler-locking on', to_string=True)
+    else:
+        status = gdb.execute('set scheduler-locking off', to_string=True)
+    if not silently:
+        print status
+
+    pyop = get_selected_pyop(silently=silently)
+    if not pyop:
+        return
+    result = run_traced(STEP_RETURN, pyop)
+    if result is None:
+        if not silently:
+            print "Unable to trace the python thread of the selected thread"
+        return
+    (_, hit, pyop) = result
+    if silently:
+        return
+    if not hit:
+        if not pybreak_stop():
+            print "Stopped before the python frame returned"
+        return
+
+    retval = read_pointers(get_symbol_address('&_pygdb_stop_arg'), 1)[0]
+    if retval:
+        value = PyObjectPtr.from_address(retval)
+        print "Value returned is %s" % value.get_truncated_repr(MAX_OUTPUT_LEN)
+    else:
+        print "Frame returned with an exception"
+    # Show where the frame returns to, if it has a python caller
+    move_in_stack(move_up=True, silently=True)
+    list_pyframe()